@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# $Id$
+#
+# Copyright (C) 2015-2016  Parsons Government Services ("PARSONS")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notices and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND PARSONS DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS.  IN NO EVENT SHALL PARSONS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT
+# OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Benchmark for replaying BGP UPDATE dumps with rpki.rtr.bgpdump: build a
+full-table-sized AXFR, write an MRT UPDATE file with a mix of
+announcements and withdrawals, and time parse_bgpdump_update().
+
+--legacy runs the same benchmark against the old sorted-list code,
+which is linear in the size of the table for every update, for
+comparison.
+"""
+
+import os
+import time
+import random
+import shutil
+import struct
+import bisect
+import argparse
+import tempfile
+import rpki.mrt
+import rpki.rtr.pdus
+import rpki.rtr.generator
+import rpki.rtr.bgpdump
+
+
+class LegacyAXFRSet(rpki.rtr.bgpdump.AXFRSet):
+    """
+    The old update code: keep the table as a sorted list, and bisect
+    and insert or delete for every update.
+    """
+
+    def parse_bgpdump_update(self, filename):
+        records = list(self.records())
+        for route in rpki.mrt.read_routes(filename):
+            if route.announce and route.origin is None:
+                continue
+            r = self.route_to_pdu(route)
+            i = bisect.bisect_left(records, r)
+            if route.announce:
+                if i >= len(records) or r != records[i]:
+                    records.insert(i, r)
+            else:
+                while i < len(records) and records[i][:-4] == r[:-4]:
+                    del records[i]
+        self.pack(records)
+
+
+def make_prefix(i):
+    """
+    Generate the i-th distinct IPv4 /24, as (address, prefixlen).
+    """
+
+    return struct.pack("!L", (i << 8) & 0xFFFFFFFF), 24
+
+
+def make_update(timestamp, withdrawn, announced, origin):
+    """
+    Generate an MRT BGP4MP_MESSAGE_AS4 record containing one UPDATE.
+    """
+
+    def nlri(prefixes):
+        return "".join(chr(prefixlen) + address[:(prefixlen + 7) >> 3] for address, prefixlen in prefixes)
+
+    w = nlri(withdrawn)
+    n = nlri(announced)
+    as_path = struct.pack("!BBLL", rpki.mrt.AS_SEQUENCE, 2, 64496, origin)
+    attributes = struct.pack("!BBB", 0x40, rpki.mrt.ATTR_AS_PATH, len(as_path)) + as_path if announced else ""
+    message = struct.pack("!H", len(w)) + w + struct.pack("!H", len(attributes)) + attributes + n
+    message = "\xff" * 16 + struct.pack("!HB", 19 + len(message), rpki.mrt.BGP_UPDATE) + message
+    body = struct.pack("!LLHH", 64496, 64497, 0, 1) + "\x01\x02\x03\x04" + "\x05\x06\x07\x08" + message
+    return rpki.mrt.header_struct.pack(timestamp, rpki.mrt.BGP4MP, 4, len(body)) + body
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--prefixes", type = int, default = 700000,
+                        help = "number of prefixes in the initial table")
+    parser.add_argument("--updates", type = int, default = 200000,
+                        help = "number of UPDATE messages to replay")
+    parser.add_argument("--withdraw-fraction", type = float, default = 0.4,
+                        help = "fraction of updates which are withdrawals")
+    parser.add_argument("--legacy", action = "store_true",
+                        help = "benchmark the old sorted-list code instead")
+    args = parser.parse_args()
+
+    random.seed(args.prefixes)
+    version = min(rpki.rtr.pdus.PDU.version_map)
+    cls = LegacyAXFRSet if args.legacy else rpki.rtr.bgpdump.AXFRSet
+
+    axfr = cls(version = version)
+    axfr.pack(rpki.rtr.generator.PrefixPDU.record_from_vrp(version, 64512 + i % 4096, address, prefixlen, prefixlen)
+              for i, (address, prefixlen) in ((i, make_prefix(i)) for i in xrange(args.prefixes)))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "updates.benchmark")
+        with open(filename, "wb") as f:
+            for i in xrange(args.updates):
+                prefix = make_prefix(random.randrange(args.prefixes * 2))
+                if random.random() < args.withdraw_fraction:
+                    f.write(make_update(1000 + i, [prefix], [], 0))
+                else:
+                    f.write(make_update(1000 + i, [], [prefix], 64512 + random.randrange(4096)))
+
+        t = time.time()
+        axfr.parse_bgpdump_update(filename)
+        t = time.time() - t
+        print "%9d prefixes %9d updates %8.2f seconds %8.2f usec/update, %d prefixes after" % (
+            args.prefixes, args.updates, t, t * 1000000.0 / args.updates, len(axfr))
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# $Id$
+#
+# Copyright (C) 2015-2016  Parsons Government Services ("PARSONS")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notices and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND PARSONS DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS.  IN NO EVENT SHALL PARSONS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT
+# OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Microbenchmark for rpki.rtr.channels.ReadBuffer: decode a stream of
+IPv4 prefix PDUs at several sizes and report time per PDU.  If
+decoding is linear in the size of the stream, time per PDU stays flat
+as the stream grows.
+
+--legacy runs the same benchmark against the old string-based buffer,
+for comparison.  That one is quadratic, so keep --count small.
+"""
+
+import time
+import struct
+import argparse
+import rpki.rtr.pdus
+import rpki.rtr.channels
+
+
+class LegacyReadBuffer(rpki.rtr.channels.ReadBuffer):
+    """
+    The old string-based ReadBuffer: appends by concatenation and
+    consumes by slicing off the front of the buffer.
+    """
+
+    def __init__(self):
+        super(LegacyReadBuffer, self).__init__()
+        self.buffer = ""
+
+    def available(self):
+        return len(self.buffer)
+
+    def peek(self, s):
+        return s.unpack(self.buffer[:s.size])
+
+    def get(self, n):
+        b = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return b
+
+    def put(self, b):
+        self.buffer += b
+
+
+def make_stream(count, version):
+    """
+    Generate wire format for count distinct IPv4 prefix PDUs.
+    """
+
+    header = rpki.rtr.pdus.IPv4PrefixPDU.header_struct
+    asnum  = rpki.rtr.pdus.IPv4PrefixPDU.asnum_struct
+    pdulen = header.size + 4 + asnum.size
+    return "".join(header.pack(version, rpki.rtr.pdus.IPv4PrefixPDU.pdu_type, pdulen, 1, 24, 24) +
+                   struct.pack("!L", (i << 8) & 0xFFFFFFFF) +
+                   asnum.pack(64512 + i % 1024)
+                   for i in xrange(count))
+
+
+def decode(stream, buffer_class, chunk):
+    """
+    Feed stream to a buffer in chunks, decoding PDUs as we go.  Return
+    the number of PDUs decoded.
+    """
+
+    reader = buffer_class()
+    rpki.rtr.pdus.PDU.read_pdu(reader)
+    n = 0
+    for i in xrange(0, len(stream), chunk):
+        reader.put(stream[i : i + chunk])
+        p = reader.retry()
+        while p is not None:
+            n += 1
+            p = rpki.rtr.pdus.PDU.read_pdu(reader)
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--count", type = int, default = 1000000,
+                        help = "number of PDUs in the largest stream")
+    parser.add_argument("--chunk", type = int, default = 1024 * 1024,
+                        help = "bytes handed to the buffer per put() call")
+    parser.add_argument("--version", type = int, default = 1,
+                        help = "RPKI-RTR protocol version")
+    parser.add_argument("--legacy", action = "store_true",
+                        help = "benchmark the old string-based buffer instead")
+    args = parser.parse_args()
+
+    buffer_class = LegacyReadBuffer if args.legacy else rpki.rtr.channels.ReadBuffer
+
+    for count in (args.count / 8, args.count / 4, args.count / 2, args.count):
+        stream = make_stream(count, args.version)
+        t = time.time()
+        n = decode(stream, buffer_class, args.chunk)
+        t = time.time() - t
+        assert n == count
+        print "%9d PDUs %11d bytes %8.2f seconds %6.2f usec/PDU" % (n, len(stream), t, t * 1000000.0 / n)
+
+
+if __name__ == "__main__":
+    main()
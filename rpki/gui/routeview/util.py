@@ -17,7 +17,6 @@ __all__ = ('import_routeviews_dump')
 
 import itertools
 import os.path
-import subprocess
 import time
 import logging
 import urlparse
@@ -29,6 +28,7 @@ from django.db import transaction
 from rpki.resource_set import resource_range_ipv4, resource_range_ipv6
 from rpki.exceptions import BadIPResource
 import rpki.gui.app.timestamp
+import rpki.mrt
 from rpki.gui.routeview.models import RouteOrigin
 
 # globals
@@ -155,26 +155,16 @@ class TextDumpParser(RouteDumpParser):
 class MrtDumpParser(RouteDumpParser):
     def __init__(self, *args, **kwargs):
         super(MrtDumpParser, self).__init__(*args, **kwargs)
-        # filter input through bgpdump
-        # bgpdump can decompress bz2 files directly, no need to do it here
-        self.pipe = subprocess.Popen(['bgpdump', '-m', '-v', self.path], stdout=subprocess.PIPE, bufsize=-1)
-        self.input = self.pipe.stdout
-
-    def parse_line(self, row):
-        a = row.split('|')
-        prefix = a[5]
-        try:
-            origin_as = int(a[6].split()[-1])
-        except ValueError:
-            raise ParseError('bad AS value')
-
-        return prefix, origin_as
-
-    def cleanup(self):
-        logger.info('waiting for child process to terminate')
-        self.pipe.wait()
-        if self.pipe.returncode:
-            raise PipeFailed('bgpdump exited with code %d' % self.pipe.returncode)
+        # rpki.mrt decodes MRT directly and handles bz2/gz files itself,
+        # no need for bgpdump or a text round trip
+        self.input = rpki.mrt.read_routes(self.path)
+
+    def parse_line(self, route):
+        "Parse one route.  Return a (prefix, origin_as) tuple."
+        if route.origin is None:
+            # AS sets, which we skip over, or a withdrawal
+            return None, None
+        return route.prefix, route.origin
 
 
 class ProgException(Exception):
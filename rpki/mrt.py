@@ -0,0 +1,377 @@
+# $Id$
+#
+# Copyright (C) 2015-2016  Parsons Government Services ("PARSONS")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notices and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND PARSONS DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS.  IN NO EVENT SHALL PARSONS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT
+# OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Streaming decoder for MRT routing information export files (RFC 6396):
+TABLE_DUMP and TABLE_DUMP_V2 RIB dumps and BGP4MP UPDATE dumps, as
+published by RouteViews and RIPE RIS.  We only extract what our
+callers need, which is unicast prefixes and their origin ASes, and we
+read bzip2 and gzip compressed files directly, so there's no need for
+the external bgpdump program or for parsing its text output.
+"""
+
+import bz2
+import gzip
+import struct
+import socket
+import logging
+import collections
+
+# MRT record types and subtypes that we understand.
+
+TABLE_DUMP              = 12
+TABLE_DUMP_V2           = 13
+BGP4MP                  = 16
+BGP4MP_ET               = 17
+
+# TABLE_DUMP_V2 subtypes, mapped to (address length, ADD-PATH).
+# Multicast and RIB_GENERIC subtypes are ignored.
+
+table_dump_v2_subtypes = {
+    2  : (4,  False),                   # RIB_IPV4_UNICAST
+    4  : (16, False),                   # RIB_IPV6_UNICAST
+    8  : (4,  True),                    # RIB_IPV4_UNICAST_ADDPATH
+    10 : (16, True) }                   # RIB_IPV6_UNICAST_ADDPATH
+
+# BGP4MP subtypes which contain BGP messages, mapped to (AS number
+# length, ADD-PATH).  State changes are ignored.
+
+bgp4mp_subtypes = {
+    1  : (2, False),                    # BGP4MP_MESSAGE
+    4  : (4, False),                    # BGP4MP_MESSAGE_AS4
+    6  : (2, False),                    # BGP4MP_MESSAGE_LOCAL
+    7  : (4, False),                    # BGP4MP_MESSAGE_AS4_LOCAL
+    8  : (2, True),                     # BGP4MP_MESSAGE_ADDPATH
+    9  : (4, True),                     # BGP4MP_MESSAGE_AS4_ADDPATH
+    10 : (2, True),                     # BGP4MP_MESSAGE_LOCAL_ADDPATH
+    11 : (4, True) }                    # BGP4MP_MESSAGE_AS4_LOCAL_ADDPATH
+
+# AFI values, mapped to address length.
+
+afi_lengths = { 1 : 4, 2 : 16 }
+
+# BGP bits and pieces.
+
+BGP_UPDATE              = 2
+ATTR_AS_PATH            = 2
+ATTR_MP_REACH_NLRI      = 14
+ATTR_MP_UNREACH_NLRI    = 15
+ATTR_AS4_PATH           = 17
+ATTR_EXTENDED_LENGTH    = 0x10
+AS_SEQUENCE             = 2
+SAFI_UNICAST            = 1
+
+header_struct = struct.Struct("!LHHL")
+u16           = struct.Struct("!H")
+u32           = struct.Struct("!L")
+asn_structs   = { 2 : u16, 4 : u32 }
+
+# Size of decompressed reads.
+
+chunk_size = 1024 * 1024
+
+
+class Route(collections.namedtuple("Route", ("timestamp", "announce", "address", "prefixlen", "origin"))):
+    """
+    One route extracted from an MRT file.  address is the prefix in
+    network byte order, zero-padded to the full length of an IPv4 or
+    IPv6 address; origin is the origin AS, or None for withdrawals and
+    for AS paths which don't end in an AS_SEQUENCE.
+    """
+
+    __slots__ = ()
+
+    @property
+    def prefix(self):
+        """
+        Text form of the prefix, eg, "10.0.0.0/8".
+        """
+
+        family = socket.AF_INET if len(self.address) == 4 else socket.AF_INET6
+        return "%s/%d" % (socket.inet_ntop(family, self.address), self.prefixlen)
+
+
+def read_chunks(filename):
+    """
+    Generate decompressed chunks of a file, which may be compressed with
+    bzip2 or gzip, judging by its name.  Python's BZ2File doesn't handle
+    files made of several bzip2 streams, which parallel compressors
+    write, so we drive the decompressor ourselves.
+    """
+
+    if filename.endswith(".bz2"):
+        with open(filename, "rb") as f:
+            decompressor = bz2.BZ2Decompressor()
+            for chunk in iter(lambda: f.read(chunk_size), ""):
+                while chunk:
+                    try:
+                        data = decompressor.decompress(chunk)
+                    except EOFError:
+                        decompressor = bz2.BZ2Decompressor()
+                        continue
+                    if data:
+                        yield data
+                    chunk = decompressor.unused_data
+                    if chunk:
+                        decompressor = bz2.BZ2Decompressor()
+    else:
+        with (gzip.open(filename, "rb") if filename.endswith(".gz") else open(filename, "rb")) as f:
+            for chunk in iter(lambda: f.read(chunk_size), ""):
+                yield chunk
+
+
+def read_records(filename):
+    """
+    Generate (timestamp, type, subtype, buffer, start, end) for each MRT
+    record in a file, where the body of the record is buffer[start:end].
+    We hand back the buffer rather than slicing out a copy of every
+    record; callers must not hang onto it.
+    """
+
+    buf = ""
+    hsize = header_struct.size
+    unpack_header = header_struct.unpack_from
+    for chunk in read_chunks(filename):
+        buf = buf + chunk if buf else chunk
+        pos = 0
+        while pos + hsize <= len(buf):
+            timestamp, rtype, subtype, length = unpack_header(buf, pos)
+            end = pos + hsize + length
+            if end > len(buf):
+                break
+            yield timestamp, rtype, subtype, buf, pos + hsize, end
+            pos = end
+        buf = buf[pos:]
+    if buf:
+        logging.warning("Ignoring %d bytes of truncated MRT record at end of %s", len(buf), filename)
+
+
+def path_origin(buf, pos, end, asn_struct):
+    """
+    Return the origin AS from an AS_PATH or AS4_PATH attribute: the
+    last AS in the path if the path ends with an AS_SEQUENCE, otherwise
+    None.
+    """
+
+    origin = None
+    size = asn_struct.size
+    while pos < end:
+        seg_type = ord(buf[pos])
+        n = ord(buf[pos + 1])
+        pos += 2 + n * size
+        if pos > end:
+            raise ValueError("AS path segment overruns attribute")
+        if seg_type != AS_SEQUENCE:
+            origin = None
+        elif n > 0:
+            origin = asn_struct.unpack_from(buf, pos - size)[0]
+    return origin
+
+
+def attribute_origin(buf, pos, end, asn_size):
+    """
+    Find the origin AS in a set of BGP path attributes.  With two-octet
+    AS numbers, the real origin is in AS4_PATH if that's present, so we
+    have to look at all the attributes; with four-octet AS numbers we
+    can stop at AS_PATH, which saves a lot of time on RIB dumps.
+    """
+
+    as_path = as4_path = None
+    while pos < end:
+        flags = ord(buf[pos])
+        code = ord(buf[pos + 1])
+        if flags & ATTR_EXTENDED_LENGTH:
+            length = u16.unpack_from(buf, pos + 2)[0]
+            pos += 4
+        else:
+            length = ord(buf[pos + 2])
+            pos += 3
+        if pos + length > end:
+            raise ValueError("Path attribute overruns attributes")
+        if code == ATTR_AS_PATH and asn_size == 4:
+            return path_origin(buf, pos, pos + length, u32)
+        if code == ATTR_AS_PATH:
+            as_path = (pos, pos + length)
+        elif code == ATTR_AS4_PATH:
+            as4_path = (pos, pos + length)
+        pos += length
+    origin = None
+    if as4_path is not None and asn_size == 2:
+        origin = path_origin(buf, as4_path[0], as4_path[1], u32)
+    if origin is None and as_path is not None:
+        origin = path_origin(buf, as_path[0], as_path[1], asn_structs[asn_size])
+    return origin
+
+
+def decode_nlri(buf, pos, end, address_length, addpath):
+    """
+    Generate (address, prefixlen) for each prefix in a block of NLRI.
+    """
+
+    padding = "\x00" * address_length
+    while pos < end:
+        if addpath:
+            pos += 4
+        prefixlen = ord(buf[pos])
+        n = (prefixlen + 7) >> 3
+        pos += 1
+        if prefixlen > address_length * 8 or pos + n > end:
+            raise ValueError("Bad NLRI prefix length %d" % prefixlen)
+        yield buf[pos : pos + n] + padding[n:], prefixlen
+        pos += n
+
+
+def decode_table_dump_v2(timestamp, subtype, buf, pos, end):
+    """
+    Decode a TABLE_DUMP_V2 RIB record.  A record holds all the paths
+    for one prefix, one per peer; we only report each origin once.
+    """
+
+    address_length, addpath = table_dump_v2_subtypes[subtype]
+    prefixlen = ord(buf[pos + 4])
+    n = (prefixlen + 7) >> 3
+    pos += 5
+    if prefixlen > address_length * 8:
+        raise ValueError("Bad RIB prefix length %d" % prefixlen)
+    address = buf[pos : pos + n] + "\x00" * (address_length - n)
+    pos += n
+    count = u16.unpack_from(buf, pos)[0]
+    pos += 2
+    skip = 10 if addpath else 6         # Peer index, originated time, path identifier
+    origins = []
+    for i in xrange(count):
+        pos += skip
+        length = u16.unpack_from(buf, pos)[0]
+        pos += 2
+        if pos + length > end:
+            raise ValueError("RIB entry overruns record")
+        origin = attribute_origin(buf, pos, pos + length, 4)
+        pos += length
+        if origin is not None and origin not in origins:
+            origins.append(origin)
+    for origin in origins:
+        yield Route(timestamp, True, address, prefixlen, origin)
+
+
+def decode_table_dump(timestamp, subtype, buf, pos, end):
+    """
+    Decode a legacy TABLE_DUMP record: one path for one prefix.
+    """
+
+    address_length = afi_lengths[subtype]
+    address = buf[pos + 4 : pos + 4 + address_length]
+    pos += 4 + address_length
+    prefixlen = ord(buf[pos])
+    pos += 2 + 4 + address_length + 2    # Prefix length, status, originated time, peer address, peer AS
+    length = u16.unpack_from(buf, pos)[0]
+    pos += 2
+    if pos + length > end or prefixlen > address_length * 8:
+        raise ValueError("Malformed TABLE_DUMP record")
+    origin = attribute_origin(buf, pos, pos + length, 2)
+    if origin is not None:
+        yield Route(timestamp, True, address, prefixlen, origin)
+
+
+def decode_bgp4mp(timestamp, rtype, subtype, buf, pos, end):
+    """
+    Decode a BGP4MP record containing a BGP UPDATE message: withdrawals
+    first, then announcements, both for IPv4 and multiprotocol NLRI.
+    """
+
+    asn_size, addpath = bgp4mp_subtypes[subtype]
+    if rtype == BGP4MP_ET:
+        pos += 4                        # Microseconds
+    pos += 2 * asn_size + 2             # Peer AS, local AS, interface index
+    afi = u16.unpack_from(buf, pos)[0]
+    pos += 2 + 2 * afi_lengths[afi]     # Peer address, local address
+    if ord(buf[pos + 18]) != BGP_UPDATE:
+        return
+    pos += 19                           # Marker, length, type
+    wlen = u16.unpack_from(buf, pos)[0]
+    pos += 2
+    withdrawn = (pos, pos + wlen)
+    pos += wlen
+    alen = u16.unpack_from(buf, pos)[0]
+    pos += 2
+    attributes = (pos, pos + alen)
+    nlri = (pos + alen, end)
+    if nlri[0] > end:
+        raise ValueError("UPDATE attributes overrun record")
+
+    # Look for multiprotocol NLRI.  We only care about unicast.
+
+    mp_reach = mp_unreach = None
+    pos = attributes[0]
+    while pos < attributes[1]:
+        flags = ord(buf[pos])
+        code = ord(buf[pos + 1])
+        if flags & ATTR_EXTENDED_LENGTH:
+            length = u16.unpack_from(buf, pos + 2)[0]
+            pos += 4
+        else:
+            length = ord(buf[pos + 2])
+            pos += 3
+        if pos + length > attributes[1]:
+            raise ValueError("Path attribute overruns attributes")
+        if code in (ATTR_MP_REACH_NLRI, ATTR_MP_UNREACH_NLRI):
+            mp_afi = u16.unpack_from(buf, pos)[0]
+            if ord(buf[pos + 2]) == SAFI_UNICAST and mp_afi in afi_lengths:
+                if code == ATTR_MP_REACH_NLRI:
+                    mp_reach = (afi_lengths[mp_afi], pos + 5 + ord(buf[pos + 3]), pos + length)
+                else:
+                    mp_unreach = (afi_lengths[mp_afi], pos + 3, pos + length)
+        pos += length
+
+    for address, prefixlen in decode_nlri(buf, withdrawn[0], withdrawn[1], 4, addpath):
+        yield Route(timestamp, False, address, prefixlen, None)
+    if mp_unreach is not None:
+        for address, prefixlen in decode_nlri(buf, mp_unreach[1], mp_unreach[2], mp_unreach[0], addpath):
+            yield Route(timestamp, False, address, prefixlen, None)
+
+    if nlri[0] == nlri[1] and mp_reach is None:
+        return
+    origin = attribute_origin(buf, attributes[0], attributes[1], asn_size)
+    for address, prefixlen in decode_nlri(buf, nlri[0], nlri[1], 4, addpath):
+        yield Route(timestamp, True, address, prefixlen, origin)
+    if mp_reach is not None:
+        for address, prefixlen in decode_nlri(buf, mp_reach[1], mp_reach[2], mp_reach[0], addpath):
+            yield Route(timestamp, True, address, prefixlen, origin)
+
+
+def read_routes(filename):
+    """
+    Generate a Route for each unicast prefix in an MRT file: each
+    distinct origin for each prefix in a RIB dump, or each announcement
+    and withdrawal in an UPDATE dump.  Malformed records are logged and
+    skipped, like bgpdump does.
+    """
+
+    for timestamp, rtype, subtype, buf, start, end in read_records(filename):
+        try:
+            if rtype == TABLE_DUMP_V2 and subtype in table_dump_v2_subtypes:
+                routes = decode_table_dump_v2(timestamp, subtype, buf, start, end)
+            elif rtype in (BGP4MP, BGP4MP_ET) and subtype in bgp4mp_subtypes:
+                routes = decode_bgp4mp(timestamp, rtype, subtype, buf, start, end)
+            elif rtype == TABLE_DUMP and subtype in afi_lengths:
+                routes = decode_table_dump(timestamp, subtype, buf, start, end)
+            else:
+                continue
+            routes = list(routes)
+        except (ValueError, KeyError, IndexError, struct.error), e:
+            logging.warning("Skipping malformed MRT record type %d subtype %d in %s: %s", rtype, subtype, filename, e)
+            continue
+        for route in routes:
+            yield route
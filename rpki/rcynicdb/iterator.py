@@ -22,12 +22,38 @@ to what wget would use) and new style (Django ORM) databases.
 """
 
 import os
+import functools
 
 initialized_django = False
 
 def _uri_to_class(uri, class_map):
     return class_map[uri[uri.rindex(".")+1:]]
 
+def _read_file(fn):
+    with open(fn, "rb") as f:
+        return f.read()
+
+def _initialize_django():
+
+    global initialized_django
+    if not initialized_django:
+        os.environ.update(DJANGO_SETTINGS_MODULE = "rpki.django_settings.rcynic")
+        import django
+        django.setup()
+        initialized_django = True
+
+def _authenticated_queryset(uri_suffix = None):
+
+    _initialize_django()
+
+    import rpki.rcynicdb
+    auth = rpki.rcynicdb.models.Authenticated.objects.order_by("-started").first()
+    if auth is None:
+        return None
+
+    q = auth.rpkiobject_set
+    return q.filter(uri__endswith = uri_suffix) if uri_suffix else q.all()
+
 def authenticated_objects(directory_tree = None, uri_suffix = None, class_map = None):
 
     if class_map is None:
@@ -47,18 +73,62 @@ def authenticated_objects(directory_tree = None, uri_suffix = None, class_map =
                     yield uri, _uri_to_class(uri, class_map).derReadFile(fn)
         return
 
-    global initialized_django
-    if not initialized_django:
-        os.environ.update(DJANGO_SETTINGS_MODULE = "rpki.django_settings.rcynic")
-        import django
-        django.setup()
-        initialized_django = True
+    q = _authenticated_queryset(uri_suffix)
+    if q is None:
+        return
+
+    for obj in q:
+        yield obj.uri, _uri_to_class(obj.uri, class_map).derRead(obj.der)
+
+def authenticated_object_keys(directory_tree = None, uri_suffix = None):
+    """
+    Iterate over authenticated objects without reading them.  Yields
+    (uri, key, reader) tuples, where key is a string which changes
+    whenever the object does (filename, modification time and size for
+    directory trees, SHA-256 for the database) and reader is a function
+    returning the object's DER.  This lets callers which cache data
+    derived from objects skip reading the ones which haven't changed.
+    """
+
+    if directory_tree:
+        for head, dirs, files in os.walk(directory_tree):
+            for fn in files:
+                if uri_suffix is None or fn.endswith(uri_suffix):
+                    fn = os.path.join(head, fn)
+                    uri = "rsync://" + fn[len(directory_tree):].lstrip("/")
+                    st = os.stat(fn)
+                    key = "%s %r %d" % (fn, st.st_mtime, st.st_size)
+                    yield uri, key, functools.partial(_read_file, fn)
+        return
+
+    q = _authenticated_queryset(uri_suffix)
+    if q is None:
+        return
+
+    for obj in q.defer("der"):
+        yield obj.uri, obj.sha256, functools.partial(getattr, obj, "der")
+
+def authenticated_generation(directory_tree = None):
+    """
+    Return a value which changes whenever a new set of authenticated
+    objects becomes available, and is cheap to check: for directory
+    trees, where rcynic swaps in each new tree with a symlink, the
+    target and inode of the tree; for the database, the most recent
+    finished validation run.  Returns None if there's nothing finished
+    to look at yet.
+    """
+
+    if directory_tree:
+        try:
+            st = os.stat(directory_tree)
+        except OSError:
+            return None
+        return os.path.realpath(directory_tree), st.st_ino, st.st_mtime
+
+    _initialize_django()
 
     import rpki.rcynicdb
     auth = rpki.rcynicdb.models.Authenticated.objects.order_by("-started").first()
-    if auth is None:
-        return
-    
-    q = auth.rpkiobject_set
-    for obj in q.filter(uri__endswith = uri_suffix) if uri_suffix else q.all():
-        yield obj.uri, _uri_to_class(obj.uri, class_map).derRead(obj.der)
+    if auth is None or auth.finished is None:
+        return None
+    return auth.pk, auth.finished
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rcynicdb', '0003_auto_20160301_0333'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ValidationCache',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('sha256', models.SlugField(max_length=64)),
+                ('issuer', models.SlugField(max_length=64)),
+                ('crl', models.SlugField(max_length=64)),
+                ('status', models.TextField()),
+                ('expires', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='validationcache',
+            unique_together=set([('sha256', 'issuer', 'crl')]),
+        ),
+    ]
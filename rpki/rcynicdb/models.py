@@ -94,3 +94,25 @@ class RPKIObject(models.Model):
             return "<RPKIObject: uri {0.uri} sha256 {0.sha256} ski {0.ski} aki {0.aki} retrieved {0.retrieved!r}>".format(self)
         except:
             return "<RPKIObject: {}>".format(id(self))
+
+# Results of signature checks from earlier runs, so that rcynicng can
+# skip checks on objects which haven't changed.  sha256, issuer and crl
+# are hex SHA-256 of the object, of the issuer's certificate and of the
+# CRL used; issuer and crl are empty where they don't apply.  status is
+# a space-separated list of the status codes the check produced.
+
+class ValidationCache(models.Model):
+    sha256  = models.SlugField(max_length = 64)
+    issuer  = models.SlugField(max_length = 64)
+    crl     = models.SlugField(max_length = 64)
+    status  = models.TextField()
+    expires = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("sha256", "issuer", "crl")
+
+    def __repr__(self):
+        try:
+            return "<ValidationCache: sha256 {0.sha256} issuer {0.issuer} crl {0.crl} expires {0.expires}>".format(self)
+        except:
+            return "<ValidationCache: {}>".format(id(self))
@@ -28,9 +28,7 @@ import time
 import glob
 import logging
 import asyncore
-import subprocess
-import bisect
-import rpki.POW
+import rpki.mrt
 import rpki.oids
 import rpki.rtr.pdus
 import rpki.rtr.server
@@ -39,107 +37,70 @@ import rpki.rtr.generator
 from rpki.rtr.channels import Timestamp
 
 
-class IgnoreThisRecord(Exception):
-    pass
-
-
-class PrefixPDU(rpki.rtr.generator.PrefixPDU):
-
-    @staticmethod
-    def from_bgpdump(line, rib_dump):
-        try:
-            assert isinstance(rib_dump, bool)
-            fields = line.split("|")
-
-            # Parse prefix, including figuring out IP protocol version
-            cls = rpki.rtr.generator.IPv6PrefixPDU if ":" in fields[5] else rpki.rtr.generator.IPv4PrefixPDU
-            self = cls(version = min(rpki.rtr.pdus.PDU.version_map))
-            self.timestamp = Timestamp(fields[1])
-            p, l = fields[5].split("/")
-            self.prefix = rpki.POW.IPAddress(p)
-            self.prefixlen = self.max_prefixlen = int(l)
-
-            # Withdrawals don't have AS paths, so be careful
-            assert fields[2] == "B" if rib_dump else fields[2] in ("A", "W")
-            if fields[2] == "W":
-                self.asn = 0
-                self.announce = 0
-            else:
-                self.announce = 1
-                if not fields[6] or "{" in fields[6] or "(" in fields[6]:
-                    raise IgnoreThisRecord
-                a  = fields[6].split()[-1]
-                if "." in a:
-                    a = [int(s) for s in a.split(".")]
-                    if len(a) != 2 or a[0] < 0 or a[0] > 65535 or a[1] < 0 or a[1] > 65535:
-                        logging.warn("Bad dotted ASNum %r, ignoring record", fields[6])
-                        raise IgnoreThisRecord
-                    a = (a[0] << 16) | a[1]
-                else:
-                    a = int(a)
-                self.asn = a
-
-            self.check()
-            return self
-
-        except IgnoreThisRecord:
-            raise
-
-        except Exception, e:
-            logging.warn("Ignoring line %r: %s", line, e)
-            raise IgnoreThisRecord
-
-
 class AXFRSet(rpki.rtr.generator.AXFRSet):
 
     serial = None
 
-    @staticmethod
-    def read_bgpdump(filename):
-        assert filename.endswith(".bz2")
-        logging.debug("Reading %s", filename)
-        bunzip2 = subprocess.Popen(("bzip2", "-c", "-d", filename), stdout = subprocess.PIPE)
-        bgpdump = subprocess.Popen(("bgpdump", "-m", "-"), stdin = bunzip2.stdout, stdout = subprocess.PIPE)
-        return bgpdump.stdout
+    def route_to_pdu(self, route):
+        """
+        Convert a route from an MRT file to the wire format of an
+        announcement.  Withdrawals get ASN zero.
+        """
+
+        return rpki.rtr.generator.PrefixPDU.record_from_vrp(self.version, route.origin or 0, route.address,
+                                                            route.prefixlen, route.prefixlen)
 
     @classmethod
     def parse_bgpdump_rib_dump(cls, filename):
         # pylint: disable=W0201
         assert os.path.basename(filename).startswith("ribs.")
+        logging.debug("Reading %s", filename)
         self = cls(version = min(rpki.rtr.pdus.PDU.version_map))
         self.serial = None
-        for line in cls.read_bgpdump(filename):
-            try:
-                pfx = PrefixPDU.from_bgpdump(line, rib_dump = True)
-            except IgnoreThisRecord:
+        timestamp = None
+        records = []
+        for route in rpki.mrt.read_routes(filename):
+            if route.origin is None:
                 continue
-            self.append(pfx)
-            self.serial = pfx.timestamp
-        if self.serial is None:
+            records.append(self.route_to_pdu(route))
+            timestamp = route.timestamp
+        if timestamp is None:
             sys.exit("Failed to parse anything useful from %s" % filename)
-        self.sort()
-        for i in xrange(len(self) - 2, -1, -1):
-            if self[i] == self[i + 1]:
-                del self[i + 1]
+        self.serial = Timestamp(timestamp)
+        self.pack(records)
         return self
 
     def parse_bgpdump_update(self, filename):
+        # Records are in wire format, which puts the prefix length ahead
+        # of the address and the ASN last, so a record less its last four
+        # bytes identifies the prefix, and matches the withdrawal (ASN
+        # zero).  Rather than keeping the whole table sorted as we go,
+        # we just keep track of changes: prefixes withdrawn from the old
+        # table, and announcements since each prefix's last withdrawal.
+        # Each update takes constant time no matter how big the table
+        # is, and we merge and sort once, at the end.
         assert os.path.basename(filename).startswith("updates.")
-        for line in self.read_bgpdump(filename):
-            try:
-                pfx = PrefixPDU.from_bgpdump(line, rib_dump = False)
-            except IgnoreThisRecord:
+        logging.debug("Reading %s", filename)
+        withdrawn = set()
+        announced = {}
+        timestamp = None
+        for route in rpki.mrt.read_routes(filename):
+            if route.announce and route.origin is None:
                 continue
-            announce = pfx.announce
-            pfx.announce = 1
-            i = bisect.bisect_left(self, pfx)
-            if announce:
-                if i >= len(self) or pfx != self[i]:
-                    self.insert(i, pfx)
+            r = self.route_to_pdu(route)
+            k = r[:-4]
+            if route.announce:
+                announced.setdefault(k, set()).add(r)
             else:
-                while i < len(self) and pfx.prefix == self[i].prefix and pfx.prefixlen == self[i].prefixlen:
-                    del self[i]
-            self.serial = pfx.timestamp
+                announced.pop(k, None)
+                withdrawn.add(k)
+            timestamp = route.timestamp
+        if timestamp is not None:
+            self.serial = Timestamp(timestamp)
+        records = [rec for rec in self.records() if rec[:-4] not in withdrawn]
+        for rs in announced.itervalues():
+            records.extend(rs)
+        self.pack(records)
 
 
 def bgpdump_convert_main(args):
@@ -184,12 +145,8 @@ def bgpdump_convert_main(args):
             db.mark_current()
         first = False
 
-        for axfr in axfrs:
-            logging.debug("Loading %s", axfr)
-            ax = AXFRSet.load(axfr)
-            logging.debug("Computing changes from %d (%s) to %d (%s)", ax.serial, ax.serial, db.serial, db.serial)
-            db.save_ixfr(ax)
-            del ax
+        logging.debug("Computing changes from %d older AXFRs to %d (%s)", len(axfrs), db.serial, db.serial)
+        db.save_ixfrs(axfrs)
 
         axfrs.append(db.filename())
 
@@ -219,7 +176,7 @@ def bgpdump_select_main(args):
         nonce = rpki.rtr.generator.AXFRSet.new_nonce(force_zero_nonce = False)
 
     rpki.rtr.server.write_current(serial, nonce, version)
-    rpki.rtr.generator.kick_all(serial)
+    rpki.rtr.generator.kick_all(serial, nonce, version)
 
 
 class BGPDumpReplayClock(object):
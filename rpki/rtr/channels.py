@@ -26,9 +26,11 @@ import sys
 import time
 import fcntl
 import errno
+import struct
 import logging
 import asyncore
 import asynchat
+import collections
 import rpki.rtr.pdus
 
 
@@ -53,12 +55,23 @@ class ReadBuffer(object):
     """
     Wrapper around synchronous/asynchronous read state.
 
+    Data is accumulated in a bytearray and consumed by advancing a read
+    offset, rather than by slicing off the front of a string, which
+    would make reading a large transfer quadratic in the size of the
+    buffer.  Consumed data is discarded every so often, when it makes
+    up at least half of the buffer, so that cost stays linear too.
+
     This also handles tracking the current protocol version,
     because it has to go somewhere and there's no better place.
     """
 
+    # Don't bother compacting the buffer until we've consumed at least
+    # this much of it.
+    compact_threshold = 65536
+
     def __init__(self):
-        self.buffer = ""
+        self.buffer = bytearray()
+        self.offset = 0
         self.version = None
         self.need = None
         self.callback = None
@@ -84,7 +97,7 @@ class ReadBuffer(object):
         How much data do we have available in this buffer?
         """
 
-        return len(self.buffer)
+        return len(self.buffer) - self.offset
 
     def needed(self):
         """
@@ -100,21 +113,32 @@ class ReadBuffer(object):
 
         return self.available() >= self.need
 
+    def peek(self, s):
+        """
+        Decode a struct from the front of the buffer without consuming it.
+        """
+
+        return s.unpack_from(memoryview(self.buffer), self.offset)
+
     def get(self, n):
         """
         Hand some data to the caller.
         """
 
-        b = self.buffer[:n]
-        self.buffer = self.buffer[n:]
-        return b
+        i = self.offset
+        n = min(n, len(self.buffer) - i)
+        self.offset = i + n
+        return memoryview(self.buffer)[i : i + n].tobytes()
 
     def put(self, b):
         """
         Accumulate some data.
         """
 
-        self.buffer += b
+        if self.offset >= self.compact_threshold and self.offset * 2 >= len(self.buffer):
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer.extend(b)
 
     def check_version(self, version):
         """
@@ -138,13 +162,43 @@ class PDUChannel(asynchat.async_chat, object):
     network I/O.  Specific engines (client, server) should be subclasses
     of this with methods that do something useful with the resulting
     PDUs.
+
+    We also do some flow control on output.  When more than
+    output_high_water bytes are queued for output, we stop reading, so
+    that a peer which sends queries faster than it reads responses
+    can't make us queue responses without limit; we start reading again
+    when sending drains the queue below output_low_water (see
+    resume_input()).  We keep track of when we last managed to send
+    anything, so that the protocol engine can give up on a peer which
+    has stopped reading entirely.
+
+    Protocol engines can also hold off reading while they wait for
+    something they need to answer a query; see hold_input().
+
+    So that we can still send a properly framed PDU after throwing away
+    queued output, we also keep track of where each piece of queued
+    output starts in the output stream; see discard_output().  We can
+    only do this for producers which tell us their content, as the
+    server's do, so after any other producer we stop keeping track
+    until the queue is discarded.
     """
 
+    output_high_water = 256 * 1024
+    output_low_water  = 64 * 1024
+
+    input_stopped = False
+    input_held = False
+
     def __init__(self, root_pdu_class, sock = None):
         asynchat.async_chat.__init__(self, sock)            # Old-style class, can't use super()
         self.reader = ReadBuffer()
         assert issubclass(root_pdu_class, rpki.rtr.pdus.PDU)
         self.root_pdu_class = root_pdu_class
+        self.output_paused = False
+        self.last_output = time.time()
+        self.output_pushed = 0
+        self.output_sent = 0
+        self.output_segments = collections.deque()
 
     @property
     def version(self):
@@ -156,14 +210,24 @@ class PDUChannel(asynchat.async_chat, object):
 
     def start_new_pdu(self):
         """
-        Start read of a new PDU.
+        Start read of a new PDU.  If too much output is queued, pause
+        instead: anything else the peer has already sent just waits in
+        the read buffer until resume_input() restarts us.
         """
 
         try:
-            p = self.root_pdu_class.read_pdu(self.reader)
-            while p is not None:
-                self.deliver_pdu(p)
+            while True:
+                if self.input_held:
+                    self.set_terminator(None)
+                    return
+                if self.output_queued() > self.output_high_water:
+                    self.output_paused = True
+                    self.set_terminator(None)
+                    return
                 p = self.root_pdu_class.read_pdu(self.reader)
+                if p is None:
+                    break
+                self.deliver_pdu(p)
         except rpki.rtr.pdus.PDUException, e:
             self.push_pdu(e.make_error_report(version = self.version))
             self.close_when_done()
@@ -191,6 +255,154 @@ class PDUChannel(asynchat.async_chat, object):
             self.deliver_pdu(p)
             self.start_new_pdu()
 
+    def output_queued(self):
+        """
+        How many bytes of output are queued but not yet sent?  Producers
+        can tell us if they have a remaining() method, otherwise we
+        don't count them.
+        """
+
+        n = 0
+        for p in self.producer_fifo:
+            if isinstance(p, (str, buffer, bytearray)):
+                n += len(p)
+            elif hasattr(p, "remaining"):
+                n += p.remaining()
+        return n
+
+    def output_stalled(self, timeout):
+        """
+        Has output been queued for more than timeout seconds without
+        our being able to send any of it?
+        """
+
+        return bool(self.producer_fifo) and time.time() > self.last_output + timeout
+
+    def readable(self):
+        """
+        Stop reading while too much output is queued or input is held,
+        see class docstring.
+        """
+
+        return not self.output_paused and not self.input_held and asynchat.async_chat.readable(self)
+
+    def hold_input(self):
+        """
+        Stop handling input after the PDU we're handling now, until
+        release_input().
+        """
+
+        self.input_held = True
+
+    def release_input(self):
+        """
+        Undo hold_input(), and pick up where start_new_pdu() left off.
+        """
+
+        self.input_held = False
+        if not self.input_stopped:
+            self.start_new_pdu()
+
+    def resume_input(self):
+        """
+        If we stopped reading because too much output was queued, and
+        output has drained enough, pick up where start_new_pdu() left off,
+        unless discard_output() told us to stop.
+        """
+
+        if self.output_paused and not self.input_stopped and self.output_queued() <= self.output_low_water:
+            self.output_paused = False
+            self.start_new_pdu()
+
+    def initiate_send(self):
+        """
+        Send what we can, then see whether that lets us resume reading.
+        We check here rather than in send(), because asynchat doesn't
+        update its queue until send() returns, and resuming can queue
+        more output.
+        """
+
+        asynchat.async_chat.initiate_send(self)
+        self.resume_input()
+
+    def push(self, data):
+        """
+        Queue data for output, noting the time if the queue was idle.
+        """
+
+        if not self.producer_fifo:
+            self.last_output = time.time()
+        if self.output_pushed is not None:
+            self.output_segments.append((self.output_pushed, data))
+            self.output_pushed += len(data)
+        asynchat.async_chat.push(self, data)
+
+    def push_with_producer(self, producer):
+        """
+        Queue a producer for output, noting the time if the queue was idle.
+        If the producer has a data attribute holding everything it will
+        produce, as the server's do, we keep track of its content for
+        discard_output(); otherwise we lose track of the output stream
+        from here on.
+        """
+
+        if not self.producer_fifo:
+            self.last_output = time.time()
+        if self.output_pushed is not None:
+            data = getattr(producer, "data", None)
+            self.output_segments.append((self.output_pushed, data))
+            self.output_pushed = None if data is None else self.output_pushed + len(data)
+        asynchat.async_chat.push_with_producer(self, producer)
+
+    def send(self, data):
+        """
+        Send some data, noting the time if we made any progress.
+        """
+
+        n = asynchat.async_chat.send(self, data)
+        if n:
+            self.last_output = time.time()
+            self.output_sent += n
+            while len(self.output_segments) > 1 and self.output_segments[1][0] <= self.output_sent:
+                self.output_segments.popleft()
+        return n
+
+    def discard_output(self, pdu = None):
+        """
+        Throw away queued output, except for the rest of any PDU we've
+        already started sending.  If pdu is given, queue it after that,
+        which makes one attempt to send it without blocking.  If we're
+        part way through output we didn't keep track of, we can't tell
+        where the current PDU ends, so we don't send pdu at all.
+
+        This is for giving up on the peer, so we also stop processing
+        input: if we'd stopped reading, we don't start again.
+        """
+
+        self.input_stopped = True
+        tail = ""
+        if self.output_segments:
+            start, data = self.output_segments[0]
+            pos = self.output_sent - start
+            if data is None and pos > 0:
+                pdu = None
+            elif data is not None and 0 < pos < len(data):
+                end = 0
+                while end < pos:
+                    end += max(8, struct.unpack("!L", data[end + 4 : end + 8])[0])
+                tail = data[pos:end]
+        self.producer_fifo.clear()
+        self.output_segments.clear()
+        self.output_pushed = self.output_sent
+        if pdu is not None:
+            tail += pdu.to_pdu()
+        if tail:
+            try:
+                self.push(tail)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
     def push_pdu(self, pdu):
         """
         Write PDU to stream.
@@ -168,6 +168,13 @@ class RouterKeyPDU(rpki.rtr.pdus.RouterKeyPDU):
 class ClientChannel(rpki.rtr.channels.PDUChannel):
     """
     Client protocol engine, handles upcalls from PDUChannel.
+
+    Prefixes and router keys we receive are not written to the SQL
+    database one at a time: we collect them until the End Of Data PDU,
+    then apply the whole change set in one transaction, with one
+    executemany() call per kind of change.  We keep changes in
+    dictionaries keyed by the record, noting whether the record was
+    withdrawn at any point and whether it was announced last.
     """
 
     serial   = None
@@ -187,6 +194,8 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         self.args = args
         self.host = args.host if host is None else host
         self.port = args.port if port is None else port
+        self.pending_prefixes = {}
+        self.pending_routerkeys = {}
         super(ClientChannel, self).__init__(sock = sock, root_pdu_class = PDU)
         if args.force_version is not None:
             self.version = args.force_version
@@ -286,6 +295,8 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         self.sql.text_factory = str
         cur = self.sql.cursor()
         cur.execute("PRAGMA foreign_keys = on")
+        if self.args.sql_bulk_load:
+            cur.execute("PRAGMA journal_mode = WAL")
         if missing:
             cur.execute('''
                 CREATE TABLE cache (
@@ -356,6 +367,8 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         """
 
         self.serial = None
+        self.pending_prefixes.clear()
+        self.pending_routerkeys.clear()
         if self.sql:
             cur = self.sql.cursor()
             cur.execute("DELETE FROM prefix WHERE cache_id = ?", (self.cache_id,))
@@ -369,6 +382,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         """
 
         assert version == self.version
+        bulk = self.args.sql_bulk_load and self.serial is None
         self.serial  = serial
         self.nonce   = nonce
         self.refresh = refresh
@@ -376,6 +390,9 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         self.expire  = expire
         self.updated = Timestamp.now()
         if self.sql:
+            if bulk:
+                self.sql.execute("PRAGMA synchronous = OFF")
+            self.apply_pending()
             self.sql.execute("UPDATE cache SET"
                              " version = ?, serial = ?, nonce  = ?,"
                              " refresh = ?, retry  = ?, expire = ?,"
@@ -383,6 +400,45 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
                              "WHERE cache_id = ?",
                              (version, serial, nonce, refresh, retry, expire, int(self.updated), self.cache_id))
             self.sql.commit()
+            if bulk:
+                self.sql.execute("PRAGMA synchronous = FULL")
+
+    def apply_pending(self):
+        """
+        Apply the changes we've collected since the last End Of Data PDU
+        to the SQL database.  Every record which was withdrawn is
+        deleted before anything is inserted, so that a record which was
+        already present, withdrawn, then announced again in the same
+        change set is replaced rather than inserted twice.  Caller is
+        responsible for committing.
+        """
+
+        cur = self.sql.cursor()
+        cur.executemany("DELETE FROM prefix "
+                        "WHERE cache_id = ? AND asn = ? AND prefix = ? AND prefixlen = ? AND max_prefixlen = ?",
+                        (values for values, (withdrawn, announced) in self.pending_prefixes.iteritems() if withdrawn))
+        cur.executemany("DELETE FROM routerkey "
+                        "WHERE cache_id = ? AND asn = ? AND (ski = ? OR key = ?)",
+                        (values for values, (withdrawn, announced) in self.pending_routerkeys.iteritems() if withdrawn))
+        cur.executemany("INSERT INTO prefix (cache_id, asn, prefix, prefixlen, max_prefixlen) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (values for values, (withdrawn, announced) in self.pending_prefixes.iteritems() if announced))
+        cur.executemany("INSERT INTO routerkey (cache_id, asn, ski, key) "
+                        "VALUES (?, ?, ?, ?)",
+                        (values for values, (withdrawn, announced) in self.pending_routerkeys.iteritems() if announced))
+        self.pending_prefixes.clear()
+        self.pending_routerkeys.clear()
+
+    @staticmethod
+    def queue_change(pending, values, announce):
+        """
+        Record one change in a pending dictionary: the value is a pair
+        of flags, whether the record has been withdrawn at any point in
+        this change set, and whether the last change was an announcement.
+        """
+
+        withdrawn, announced = pending.get(values, (False, False))
+        pending[values] = (withdrawn or not announce, announce)
 
     def consume_prefix(self, prefix):
         """
@@ -391,14 +447,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
 
         if self.sql:
             values = (self.cache_id, prefix.asn, str(prefix.prefix), prefix.prefixlen, prefix.max_prefixlen)
-            if prefix.announce:
-                self.sql.execute("INSERT INTO prefix (cache_id, asn, prefix, prefixlen, max_prefixlen) "
-                                 "VALUES (?, ?, ?, ?, ?)",
-                                 values)
-            else:
-                self.sql.execute("DELETE FROM prefix "
-                                 "WHERE cache_id = ? AND asn = ? AND prefix = ? AND prefixlen = ? AND max_prefixlen = ?",
-                                 values)
+            self.queue_change(self.pending_prefixes, values, prefix.announce)
 
     def consume_routerkey(self, routerkey):
         """
@@ -409,14 +458,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
             values = (self.cache_id, routerkey.asn,
                       base64.urlsafe_b64encode(routerkey.ski).rstrip("="),
                       base64.b64encode(routerkey.key))
-            if routerkey.announce:
-                self.sql.execute("INSERT INTO routerkey (cache_id, asn, ski, key) "
-                                 "VALUES (?, ?, ?, ?)",
-                                 values)
-            else:
-                self.sql.execute("DELETE FROM routerkey "
-                                 "WHERE cache_id = ? AND asn = ? AND (ski = ? OR key = ?)",
-                                 values)
+            self.queue_change(self.pending_routerkeys, values, routerkey.announce)
 
     def deliver_pdu(self, pdu):
         """
@@ -526,6 +568,8 @@ def argparse_setup(subparsers):
     subparser.add_argument("--sql-database", help = "filename for sqlite3 database of client state")
     subparser.add_argument("--force-version", type = int, choices = PDU.version_map, help = "force specific protocol version")
     subparser.add_argument("--reset-session", action = "store_true", help = "reset any existing session found in sqlite3 database")
+    subparser.add_argument("--sql-bulk-load", action = "store_true",
+                           help = "use WAL journal, and skip synchronous writes while loading a full data set into sqlite3 database")
     subparser.add_argument("protocol", choices = ("loopback", "tcp", "ssh", "tls"), help = "connection protocol")
     subparser.add_argument("host", nargs = "?", help = "server host")
     subparser.add_argument("port", nargs = "?", help = "server port")
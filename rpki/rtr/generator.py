@@ -23,11 +23,20 @@ Database generator for RPKI-RTR server (RFC 6810 et sequalia).
 
 import os
 import sys
+import time
 import glob
+import mmap
+import array
 import socket
 import base64
 import random
+import hashlib
 import logging
+import cPickle
+import itertools
+import collections
+import multiprocessing
+import signal
 import subprocess
 import rpki.POW
 import rpki.oids
@@ -37,7 +46,7 @@ import rpki.rtr.server
 
 from rpki.rtr.channels import Timestamp
 
-from rpki.rcynicdb.iterator import authenticated_objects
+from rpki.rcynicdb.iterator import authenticated_object_keys, authenticated_generation
 
 class PrefixPDU(rpki.rtr.pdus.PrefixPDU):
     """
@@ -86,6 +95,27 @@ class PrefixPDU(rpki.rtr.pdus.PrefixPDU):
         self.check()
         return self
 
+    @staticmethod
+    def record_from_vrp(version, asn, address, prefixlen, max_prefixlen):
+        """
+        Construct the wire format of an announcement directly from a
+        compact (asn, address, prefixlen, max_prefixlen) tuple, without
+        the overhead of constructing a PDU object.
+        """
+
+        cls = IPv6PrefixPDU if len(address) == IPv6PrefixPDU.address_byte_count else IPv4PrefixPDU
+        if len(address) != cls.address_byte_count:
+            raise rpki.rtr.pdus.CorruptData("Implausible address length %d" % len(address))
+        bits = cls.address_byte_count * 8
+        if prefixlen < 0 or prefixlen > bits:
+            raise rpki.rtr.pdus.CorruptData("Implausible prefix length %d" % prefixlen)
+        if max_prefixlen < prefixlen or max_prefixlen > bits:
+            raise rpki.rtr.pdus.CorruptData("Implausible max prefix length %d" % max_prefixlen)
+        pdulen = cls.header_struct.size + cls.address_byte_count + cls.asnum_struct.size
+        return (cls.header_struct.pack(version, cls.pdu_type, pdulen, 1, prefixlen, max_prefixlen) +
+                address +
+                cls.asnum_struct.pack(asn))
+
 
 class IPv4PrefixPDU(PrefixPDU):
     """
@@ -178,44 +208,389 @@ class X509(rpki.POW.X509):              # pylint: disable=W0232
                     yield asn
 
 
-class PDUSet(list):
+def extract_roa(der):
+    """
+    Extract prefixes from a ROA, as a list of compact
+    (asn, address, prefixlen, max_prefixlen) tuples, with the address
+    in binary form.  Tuples rather than PDUs, because these may be on
+    their way back from a worker process.
+    """
+
+    roa = ROA.derRead(der)
+    roa.extractWithoutVerifying()
+    asn = roa.getASID()
+    return [(asn, address.toBytes(), length, length if maxlength is None else maxlength)
+            for address, length, maxlength in roa.prefixes]
+
+
+def extract_router_certificate(der):
+    """
+    Extract router keys from a certificate, as a list of compact
+    (asn, ski, key) tuples.  Certificates which aren't BGPSEC router
+    certificates yield nothing.
+    """
+
+    cer = X509.derRead(der)
+    eku = cer.getEKU()
+    if eku is None or rpki.oids.id_kp_bgpsec_router not in eku:
+        return []
+    ski = cer.getSKI()
+    key = cer.getPublicKey().derWritePublic()
+    return [(asn, ski, key) for asn in cer.asns]
+
+
+extractors = dict(roa = extract_roa, cer = extract_router_certificate)
+
+def extract_chunk(chunk):
+    """
+    Run the appropriate extractor over a chunk of objects.  This is
+    the function we hand to worker processes, so it has to live at
+    module level and take a single picklable argument, which is a
+    (uri_suffix, list of (key, DER) tuples) tuple.  Returns a list of
+    (key, extracted tuples) tuples.
+    """
+
+    suffix, objects = chunk
+    extractor = extractors[suffix]
+    return [(key, extractor(der)) for key, der in objects]
+
+
+class ExtractCache(object):
+    """
+    Cache of extracted tuples, keyed by object key as
+    returned by authenticated_object_keys().  Between two rcynic runs
+    only a small fraction of objects change, so remembering what we got
+    out of each object last time saves us from reading and decoding the
+    rest.  Entries for objects which have vanished are dropped whenever
+    a complete extraction pass replaces the entries for its suffix.
+    With no filename, the cache lives only in memory, which is what the
+    generator daemon wants.
+    """
+
+    # Bump this if the format of the extracted tuples changes.
+    cache_format = 1
+
+    def __init__(self, filename = None):
+        self.filename = filename
+        self.entries = {}
+        if filename is None:
+            return
+        try:
+            with open(filename, "rb") as f:
+                cache_format, entries = cPickle.load(f)
+            if cache_format == self.cache_format:
+                self.entries = entries
+            else:
+                logging.debug("# Ignoring extraction cache %s with unknown format %r", filename, cache_format)
+        except IOError:
+            pass
+        except Exception, e:
+            logging.warning("# Ignoring unreadable extraction cache %s: %s", filename, e)
+
+    def get(self, suffix):
+        """
+        Return the mapping from object key to extracted tuples for objects
+        with a particular suffix.
+        """
+
+        return self.entries.get(suffix, {})
+
+    def set(self, suffix, mapping):
+        """
+        Replace the mapping for objects with a particular suffix.
+        """
+
+        self.entries[suffix] = mapping
+
+    def save(self):
+        """
+        Write cache to disk, unless it's an in-memory cache.
+        """
+
+        if self.filename is None:
+            return
+        tmpfn = "%s.%d.tmp" % (self.filename, os.getpid())
+        with open(tmpfn, "wb") as f:
+            cPickle.dump((self.cache_format, self.entries), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfn, self.filename)
+
+
+class PDUSet(object):
     """
     Object representing a set of PDUs, that is, one versioned and
     (theoretically) consistant set of prefixes and router keys extracted
     from rcynic's output.
+
+    With hundreds of thousands of PDUs per set, keeping a Python object
+    for every PDU costs far more in object overhead and comparison time
+    than the data itself is worth.  So we don't: we keep the wire format
+    of each PDU as a record in one contiguous buffer, with an array of
+    offsets marking the record boundaries.  Since we already use lexical
+    ordering of the wire format as the ordering for PDUs, sorting the
+    records by their bytes gives the same order as sorting the PDUs.
+    PDU objects are only constructed on demand, when somebody indexes
+    or iterates over the set.
     """
 
+    header_struct = rpki.rtr.pdus.PDU.header_struct
+
     def __init__(self, version):
         assert version in rpki.rtr.pdus.PDU.version_map
-        super(PDUSet, self).__init__()
         self.version = version
+        self.buffer = ""
+        self.offsets = array.array("I", (0,))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.decode(self.record(i))
+
+    def __iter__(self):
+        for r in self.records():
+            yield self.decode(r)
+
+    def __eq__(self, other):
+        return isinstance(other, PDUSet) and self.version == other.version and self.buffer == other.buffer
+
+    def __ne__(self, other):
+        return not self == other
+
+    def digest(self):
+        """
+        Return a hex SHA-256 digest of the content of this set.  Since the
+        buffer is exactly what we write to disk, this is also the digest
+        of the file we write.
+        """
+
+        return hashlib.sha256(self.buffer).hexdigest()
+
+    def record(self, i):
+        """
+        Return the wire format of the i-th PDU in this set.
+        """
+
+        if i < 0:
+            i += len(self)
+        return self.buffer[self.offsets[i] : self.offsets[i + 1]]
+
+    def records(self):
+        """
+        Iterate over the wire format PDUs in this set.
+        """
+
+        offsets = self.offsets
+        for i in xrange(len(offsets) - 1):
+            yield self.buffer[offsets[i] : offsets[i + 1]]
+
+    def items(self):
+        """
+        Iterate over the content of this set in compact form: tuples for
+        prefixes, PDU objects for everything else.  See
+        rpki.rtr.pdus.decode_pdus() for details.
+        """
+
+        return rpki.rtr.pdus.decode_pdus(self.buffer, self.version)
+
+    def show_records(self):
+        """
+        Log the content of this set, one PDU per line.  We use items()
+        rather than iterating over PDU objects, since a full AXFR is a
+        lot of prefixes.
+        """
+
+        format_prefix = rpki.rtr.pdus.PrefixPDU.format_prefix
+        fromBytes = rpki.POW.IPAddress.fromBytes
+        for item, record in itertools.izip(self.items(), self.records()):
+            if isinstance(item, tuple):
+                announce, asn, address, prefixlen, max_prefixlen = item
+                item = format_prefix(announce, asn, fromBytes(address), prefixlen, max_prefixlen, record)
+            logging.debug(item)
+
+    @staticmethod
+    def decode(record):
+        """
+        Construct a PDU object from its wire format.
+        """
+
+        r = rpki.rtr.channels.ReadBuffer()
+        r.put(record)
+        p = rpki.rtr.pdus.PDU.read_pdu(r)
+        assert p is not None and r.available() == 0
+        return p
+
+    def set_announce(self, record, announce):
+        """
+        Return a copy of a wire format PDU with its announce flag set to
+        the specified value.
+        """
+
+        pdu_type = ord(record[1])
+        i = rpki.rtr.pdus.PDU.version_map[self.version][pdu_type].announce_offset
+        return record[:i] + chr(announce) + record[i + 1:]
+
+    def pack(self, records):
+        """
+        Replace the content of this set with a collection of wire format
+        PDUs, sorted and with duplicates removed.
+        """
+
+        records = sorted(set(records))
+        offsets = array.array("I", (0,))
+        n = 0
+        for r in records:
+            n += len(r)
+            offsets.append(n)
+        self.buffer = "".join(records)
+        self.offsets = offsets
 
     @classmethod
     def _load_file(cls, filename, version):
         """
-        Low-level method to read PDUSet from a file.
+        Low-level method to read PDUSet from a file.  All we need to do
+        here is find the record boundaries, so we only look at the PDU
+        headers.
         """
 
         self = cls(version = version)
-        f = open(filename, "rb")
-        r = rpki.rtr.channels.ReadBuffer()
-        while True:
-            p = rpki.rtr.pdus.PDU.read_pdu(r)
-            while p is None:
-                b = f.read(r.needed())
-                if b == "":
-                    assert r.available() == 0
-                    return self
-                r.put(b)
-                p = r.retry()
-            assert p.version == self.version
-            self.append(p)
+        with open(filename, "rb") as f:
+            b = f.read()
+        version_map = rpki.rtr.pdus.PDU.version_map[version]
+        header_size = self.header_struct.size
+        offsets = self.offsets
+        i = 0
+        while i < len(b):
+            if len(b) - i < header_size:
+                raise rpki.rtr.pdus.CorruptData("Truncated PDU header in %s" % filename)
+            v, pdu_type, length = self.header_struct.unpack_from(b, i)
+            assert v == version
+            if pdu_type not in version_map:
+                raise rpki.rtr.pdus.UnsupportedPDUType("Unsupported PDU type %d in %s" % (pdu_type, filename))
+            if length < header_size or i + length > len(b):
+                raise rpki.rtr.pdus.CorruptData("Bad PDU length %d in %s" % (length, filename))
+            i += length
+            offsets.append(i)
+        self.buffer = b
+        return self
 
     @staticmethod
     def seq_ge(a, b):
         return ((a - b) % (1 << 32)) < (1 << 31)
 
 
+class RecordFile(object):
+    """
+    Sequential reader for the wire format records in a PDU file.  The
+    file is mmap()ed, and we only ever look at PDU headers and slice out
+    the current record, so memory use doesn't depend on the file size
+    and no PDU objects are constructed.  .current is the current record,
+    or None once we've run out.
+    """
+
+    header_struct = rpki.rtr.pdus.PDU.header_struct
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.current = None
+        with open(filename, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) if self.size > 0 else None
+        self.advance()
+
+    def advance(self):
+        """
+        Move to the next record.
+        """
+
+        if self.offset >= self.size:
+            self.current = None
+            return
+        if self.size - self.offset < self.header_struct.size:
+            raise rpki.rtr.pdus.CorruptData("Truncated PDU header in %s" % self.filename)
+        length = self.header_struct.unpack_from(self.map, self.offset)[2]
+        if length < self.header_struct.size or self.offset + length > self.size:
+            raise rpki.rtr.pdus.CorruptData("Bad PDU length %d in %s" % (length, self.filename))
+        self.current = self.map[self.offset : self.offset + length]
+        self.offset += length
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class IXFRWriter(object):
+    """
+    One of the side by side comparisons in AXFRSet.save_ixfrs(): an old
+    AXFR file, read as raw records, and the IXFR file we're writing from
+    it.  If the IXFR grows past an optional size limit, we give up on it
+    and delete it, leaving an empty marker file (".nx." in place of
+    ".ix.") so that the server knows to send a Cache Reset rather than
+    computing the IXFR itself.
+    """
+
+    def __init__(self, axfr, filename, limit = None):
+        fn1, fn2, fn3 = os.path.basename(filename).split(".")
+        assert fn1.isdigit() and fn2 == "ax" and fn3 == "v%d" % axfr.version
+        self.axfr = axfr
+        self.limit = limit
+        self.written = 0
+        self.filename = "%d.ix.%d.v%d" % (axfr.serial, int(fn1), axfr.version)
+        self.old = RecordFile(filename)
+        self.f = open(self.filename, "wb")
+
+    def write(self, record, announce):
+        """
+        Write one record with the specified announce flag, unless we've
+        already given up on this IXFR.
+        """
+
+        if self.f is None:
+            return
+        self.written += len(record)
+        if self.limit is not None and self.written > self.limit:
+            logging.debug("# %s would be larger than %d bytes, skipping", self.filename, self.limit)
+            self.f.close()
+            self.f = None
+            os.unlink(self.filename)
+            open(self.filename.replace(".ix.", ".nx.", 1), "wb").close()
+            return
+        self.f.write(self.axfr.set_announce(record, announce))
+
+    def compare(self, r_new):
+        """
+        Advance comparison to the next record of the new AXFR.
+        """
+
+        old = self.old
+        while self.f is not None and old.current is not None and old.current < r_new:
+            self.write(old.current, 0)
+            old.advance()
+        if self.f is None:
+            return
+        if old.current == r_new:
+            old.advance()
+        else:
+            self.write(r_new, 1)
+
+    def finish(self):
+        """
+        Ran out of new records, anything left in the old AXFR is a withdrawal.
+        """
+
+        old = self.old
+        while self.f is not None and old.current is not None:
+            self.write(old.current, 0)
+            old.advance()
+
+    def close(self):
+        self.old.close()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
 class AXFRSet(PDUSet):
     """
     Object representing a complete set of PDUs, that is, one versioned
@@ -224,15 +599,96 @@ class AXFRSet(PDUSet):
     field set.
     """
 
-    class_map = dict(cer = X509, roa = ROA)
-
     serial = None
 
+    # Number of objects we hand to a worker process at once.
+    extract_chunk_size = 256
+
     @classmethod
-    def parse_rcynic(cls, rcynic_dir, version, scan_roas = None, scan_routercerts = None):
+    def extract(cls, rcynic_dir, suffix, jobs = 1, cache = None):
         """
-        Parse ROAS and router certificates fetched (and validated!) by
-        rcynic to create a new AXFRSet.
+        Extract compact tuples from all the authenticated objects with a
+        particular suffix, using a pool of worker processes if jobs is
+        greater than one.  Results arrive in no particular order, which
+        is fine, since the caller is going to sort them anyway.
+
+        We read the objects ourselves and hand the workers their content,
+        keeping a bounded number of chunks in flight.  Giving chunks() to
+        imap_unordered() would have the pool's task handler thread
+        running it, database queries and updates to found and hits
+        included.
+
+        If we have an ExtractCache, we only read objects we haven't seen
+        before, then update the cache with what we found this time.
+        """
+
+        cached = {} if cache is None else cache.get(suffix)
+        found = {}
+        hits = []
+
+        def chunks():
+            chunk = []
+            for uri, key, reader in authenticated_object_keys(rcynic_dir, uri_suffix = "." + suffix):
+                if key in cached:
+                    found[key] = cached[key]
+                    hits.append(key)
+                    continue
+                chunk.append((key, reader()))
+                if len(chunk) >= cls.extract_chunk_size:
+                    yield suffix, chunk
+                    chunk = []
+            if chunk:
+                yield suffix, chunk
+
+        def pooled():
+            pending = collections.deque()
+            for args in chunks():
+                pending.append(pool.apply_async(extract_chunk, (args,)))
+                while pending and (len(pending) > 2 * jobs or pending[0].ready()):
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+        if jobs <= 1:
+            results = itertools.imap(extract_chunk, chunks())
+            pool = None
+        else:
+            pool = multiprocessing.Pool(jobs)
+            results = pooled()
+
+        try:
+            for result in results:
+                for key, tuples in result:
+                    found[key] = tuples
+                    for t in tuples:
+                        yield t
+            if pool is not None:
+                pool.close()
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.join()
+
+        for key in hits:
+            for t in found[key]:
+                yield t
+
+        if cache is not None:
+            logging.debug("# Extracted %d .%s objects, %d from cache", len(found), suffix, len(hits))
+            cache.set(suffix, found)
+
+    @classmethod
+    def extract_rcynic(cls, rcynic_dir, scan_roas = None, scan_routercerts = None, jobs = 1, cache = None):
+        """
+        Extract prefixes and router keys from ROAS and router certificates
+        fetched (and validated!) by rcynic.  Result is a version-neutral
+        (prefixes, routerkeys) tuple of lists of compact tuples, which
+        from_extracted() turns into an AXFRSet for a particular protocol
+        version, so we only have to do this once no matter how many
+        protocol versions we support.
 
         In normal operation, we parse these data directly from whatever rcynic is using
         as a validator this week, but we can, if so instructed, use external programs
@@ -241,28 +697,24 @@ class AXFRSet(PDUSet):
         At some point the ability to parse these data from external
         programs may move to a separate constructor function, so that we
         can make this one a bit simpler and faster.
+
+        Extraction from rcynic's output can be spread across multiple
+        worker processes by setting jobs, and can skip unchanged objects
+        if given an ExtractCache; output is the same either way.
         """
 
-        self = cls(version = version)
-        self.serial = rpki.rtr.channels.Timestamp.now()
+        include_routercerts = any(RouterKeyPDU.pdu_type in pdu_map
+                                  for pdu_map in rpki.rtr.pdus.PDU.version_map.itervalues())
+        version = min(rpki.rtr.pdus.PDU.version_map)
 
-        include_routercerts = RouterKeyPDU.pdu_type in rpki.rtr.pdus.PDU.version_map[version]
+        prefixes = []
+        routerkeys = []
 
         if scan_roas is None:
-            for uri, roa in authenticated_objects(rcynic_dir, uri_suffix = ".roa", class_map = self.class_map):
-                roa.extractWithoutVerifying()
-                asn = roa.getASID()
-                self.extend(PrefixPDU.from_roa(version = version, asn = asn, prefix_tuple = prefix_tuple)
-                            for prefix_tuple in roa.prefixes)
+            prefixes.extend(cls.extract(rcynic_dir, "roa", jobs, cache))
 
         if scan_routercerts is None and include_routercerts:
-            for uri, cer in authenticated_objects(rcynic_dir, uri_suffix = ".cer", class_map = self.class_map):
-                eku = cer.getEKU()
-                if eku is not None and rpki.oids.id_kp_bgpsec_router in eku:
-                    ski = cer.getSKI()
-                    key = cer.getPublicKey().derWritePublic()
-                    self.extend(RouterKeyPDU.from_certificate(version = version, asn = asn, ski = ski, key = key)
-                                for asn in cer.asns)
+            routerkeys.extend(cls.extract(rcynic_dir, "cer", jobs, cache))
 
         if scan_roas is not None:
             try:
@@ -270,8 +722,9 @@ class AXFRSet(PDUSet):
                 for line in p.stdout:
                     line = line.split()
                     asn = line[1]
-                    self.extend(PrefixPDU.from_text(version = version, asn = asn, addr = addr)
-                                for addr in line[2:])
+                    for addr in line[2:]:
+                        pdu = PrefixPDU.from_text(version = version, asn = asn, addr = addr)
+                        prefixes.append((pdu.asn, pdu.prefix.toBytes(), pdu.prefixlen, pdu.max_prefixlen))
             except OSError, e:
                 sys.exit("Could not run %s: %s" % (scan_roas, e))
 
@@ -282,17 +735,42 @@ class AXFRSet(PDUSet):
                     line = line.split()
                     gski = line[0]
                     key  = line[-1]
-                    self.extend(RouterKeyPDU.from_text(version = version, asn = asn, gski = gski, key = key)
-                                for asn in line[1:-1])
+                    for asn in line[1:-1]:
+                        pdu = RouterKeyPDU.from_text(version = version, asn = asn, gski = gski, key = key)
+                        routerkeys.append((pdu.asn, pdu.ski, pdu.key))
             except OSError, e:
                 sys.exit("Could not run %s: %s" % (scan_routercerts, e))
 
-        self.sort()
-        for i in xrange(len(self) - 2, -1, -1):
-            if self[i] == self[i + 1]:
-                del self[i + 1]
+        return prefixes, routerkeys
+
+    @classmethod
+    def from_extracted(cls, version, serial, prefixes, routerkeys):
+        """
+        Create a new AXFRSet for a particular protocol version from the
+        version-neutral output of extract_rcynic().
+        """
+
+        self = cls(version = version)
+        self.serial = serial
+        records = [PrefixPDU.record_from_vrp(version, *vrp) for vrp in prefixes]
+        if RouterKeyPDU.pdu_type in rpki.rtr.pdus.PDU.version_map[version]:
+            records.extend(RouterKeyPDU.from_certificate(version = version, asn = asn, ski = ski, key = key).to_pdu()
+                           for asn, ski, key in routerkeys)
+        self.pack(records)
         return self
 
+    @classmethod
+    def parse_rcynic(cls, rcynic_dir, version, scan_roas = None, scan_routercerts = None, jobs = 1, cache = None):
+        """
+        Parse ROAS and router certificates fetched (and validated!) by
+        rcynic to create a new AXFRSet for a single protocol version.
+        If you need more than one version, call extract_rcynic() and
+        from_extracted() yourself.
+        """
+
+        prefixes, routerkeys = cls.extract_rcynic(rcynic_dir, scan_roas, scan_routercerts, jobs, cache)
+        return cls.from_extracted(version, rpki.rtr.channels.Timestamp.now(), prefixes, routerkeys)
+
     @classmethod
     def load(cls, filename):
         """
@@ -327,14 +805,34 @@ class AXFRSet(PDUSet):
         except IOError:
             return None
 
+    @classmethod
+    def current_digest(cls, version):
+        """
+        Return the content digest of the current AXFRSet, without loading
+        it.  If the digest isn't recorded, compute it from the raw file,
+        which is still a lot cheaper than decoding.  Return None if we
+        can't do either.
+        """
+
+        digest = rpki.rtr.server.read_current_digest(version)
+        if digest is not None:
+            return digest
+        serial = rpki.rtr.server.read_current(version)[0]
+        if serial is None:
+            return None
+        try:
+            with open("%d.ax.v%d" % (serial, version), "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except IOError:
+            return None
+
     def save_axfr(self):
         """
         Write AXFRSet to file with magic filename.
         """
 
         f = open(self.filename(), "wb")
-        for p in self:
-            f.write(p.to_pdu())
+        f.write(self.buffer)
         f.close()
 
     def destroy_old_data(self):
@@ -343,7 +841,7 @@ class AXFRSet(PDUSet):
         the old serial numbers are no longer valid.
         """
 
-        for i in glob.iglob("*.ix.*.v%d" % self.version):
+        for i in glob.glob("*.ix.*.v%d" % self.version) + glob.glob("*.nx.*.v%d" % self.version):
             os.unlink(i)
         for i in glob.iglob("*.ax.v%d" % self.version):
             if i != self.filename():
@@ -366,7 +864,7 @@ class AXFRSet(PDUSet):
         """
         Save current serial number and nonce, creating new nonce if
         necessary.  Creating a new nonce triggers cleanup of old state, as
-        the new nonce invalidates all old serial numbers.
+        the new nonce invalidates all old serial numbers.  Returns the nonce.
         """
 
         assert self.version in rpki.rtr.pdus.PDU.version_map
@@ -375,46 +873,86 @@ class AXFRSet(PDUSet):
             logging.debug("Creating new nonce and deleting stale data")
             nonce = self.new_nonce(force_zero_nonce)
             self.destroy_old_data()
-        rpki.rtr.server.write_current(self.serial, nonce, self.version)
+        rpki.rtr.server.write_current(self.serial, nonce, self.version, self.digest())
+        return nonce
 
-    def save_ixfr(self, other):
+    def ixfr_records(self, other):
         """
-        Comparing this AXFRSet with an older one and write the resulting
-        IXFRSet to file with magic filename.  Since we store PDUSets
+        Compare this AXFRSet with an older one and generate the wire
+        format records of the resulting IXFRSet.  Since we store PDUSets
         in sorted order, computing the difference is a trivial linear
         comparison.
         """
 
-        f = open("%d.ix.%d.v%d" % (self.serial, other.serial, self.version), "wb")
         old = other
         new = self
         len_old = len(old)
         len_new = len(new)
         i_old = i_new = 0
         while i_old < len_old and i_new < len_new:
-            if old[i_old] < new[i_new]:
-                f.write(old[i_old].to_pdu(announce = 0))
+            r_old = old.record(i_old)
+            r_new = new.record(i_new)
+            if r_old < r_new:
+                yield self.set_announce(r_old, 0)
                 i_old += 1
-            elif old[i_old] > new[i_new]:
-                f.write(new[i_new].to_pdu(announce = 1))
+            elif r_old > r_new:
+                yield self.set_announce(r_new, 1)
                 i_new += 1
             else:
                 i_old += 1
                 i_new += 1
         for i in xrange(i_old, len_old):
-            f.write(old[i].to_pdu(announce = 0))
+            yield self.set_announce(old.record(i), 0)
         for i in xrange(i_new, len_new):
-            f.write(new[i].to_pdu(announce = 1))
+            yield self.set_announce(new.record(i), 1)
+
+    def save_ixfr(self, other):
+        """
+        Compare this AXFRSet with an older one and write the resulting
+        IXFRSet to file with magic filename.
+        """
+
+        f = open("%d.ix.%d.v%d" % (self.serial, other.serial, self.version), "wb")
+        f.writelines(self.ixfr_records(other))
         f.close()
 
+    def save_ixfrs(self, filenames, max_ratio = None):
+        """
+        Compare this AXFRSet with any number of older AXFR files and write
+        the resulting IXFRSets to files with magic filenames, all in one
+        pass.  This is the same linear comparison as save_ixfr(), but we
+        run all the comparisons side by side while walking this set once,
+        and read the old AXFRs as raw records via RecordFile rather than
+        loading them, so memory use stays flat no matter how many old
+        AXFRs we have.
+
+        If max_ratio is set, we abandon any IXFR which grows larger than
+        that fraction of this AXFR: a client that far behind is better
+        off with a Cache Reset, which is what the server sends when it
+        finds the marker file IXFRWriter leaves in place of the IXFR.
+        """
+
+        limit = None if max_ratio is None else int(len(self.buffer) * max_ratio)
+        writers = []
+        try:
+            for filename in filenames:
+                writers.append(IXFRWriter(self, filename, limit))
+            for r_new in self.records():
+                for w in writers:
+                    w.compare(r_new)
+            for w in writers:
+                w.finish()
+        finally:
+            for w in writers:
+                w.close()
+
     def show(self):
         """
         Print this AXFRSet.
         """
 
         logging.debug("# AXFR %d (%s) v%d", self.serial, self.serial, self.version)
-        for p in self:
-            logging.debug(p)
+        self.show_records()
 
 
 class IXFRSet(PDUSet):
@@ -459,13 +997,39 @@ class IXFRSet(PDUSet):
                       self.from_serial, self.from_serial,
                       self.to_serial,   self.to_serial,
                       self.version)
-        for p in self:
-            logging.debug(p)
+        self.show_records()
+
+
+def expire_axfrs(version, current, max_age = None, max_count = None, max_bytes = None):
+    """
+    Apply retention policy to the AXFR files for one protocol version.
+    Starting with the newest, we keep files while they're younger than
+    max_age seconds, fewer than max_count files, and no more than
+    max_bytes bytes in total; the rest get deleted.  Each AXFR we keep
+    costs an IXFR file on every run, so this bounds both disk use and
+    cronjob time.  The current AXFR is always kept.
+    """
+
+    axfrs = sorted(((Timestamp(int(f.split(".")[0])), f) for f in glob.iglob("*.ax.v%d" % version)), reverse = True)
+    cutoff = None if max_age is None else Timestamp.now(-max_age)
+    count = total = 0
+    for t, f in axfrs:
+        size = os.path.getsize(f)
+        if t != current and ((cutoff is not None and t < cutoff) or
+                             (max_count is not None and count >= max_count) or
+                             (max_bytes is not None and total + size > max_bytes)):
+            logging.debug("# Deleting old file %s, timestamp %s", f, t)
+            os.unlink(f)
+        else:
+            count += 1
+            total += size
 
 
-def kick_all(serial):
+def kick_all(serial, nonce = None, version = None):
     """
-    Kick any existing server processes to wake them up.
+    Kick any existing server processes to wake them up.  If we know
+    the nonce and protocol version, the kick message includes them, so
+    that servers needn't read current.v* to find out what changed.
     """
 
     try:
@@ -474,7 +1038,7 @@ def kick_all(serial):
         logging.debug('# Creating directory "%s"', rpki.rtr.server.kickme_dir)
         os.makedirs(rpki.rtr.server.kickme_dir)
 
-    msg = "Good morning, serial %d is ready" % serial
+    msg = rpki.rtr.server.format_kick(serial, nonce, version)
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
     for name in glob.iglob("%s.*" % rpki.rtr.server.kickme_base):
         try:
@@ -491,6 +1055,68 @@ def kick_all(serial):
     sock.close()
 
 
+def generate(args, cache = None, digests = None):
+    """
+    Wade through the ROAs and router certificates that rcynic collects
+    and update the database: for each protocol version whose data have
+    changed, write a new AXFR and IXFRs against older AXFRs, mark the
+    new AXFR current, and kick any active servers.  This is all of one
+    cronjob run, and one cycle of the generator daemon.
+
+    digests, if given, maps protocol version to the content digest of
+    the current AXFR, so that the generator daemon needn't consult the
+    disk to find out whether anything changed; we keep it up to date.
+    Returns the number of protocol versions which got a new serial.
+    """
+
+    prefixes, routerkeys = rpki.rtr.generator.AXFRSet.extract_rcynic(args.rcynic_dir, args.scan_roas,
+                                                                     args.scan_routercerts, args.jobs, cache)
+    serial = Timestamp.now()
+    changed = 0
+
+    for version in sorted(rpki.rtr.server.PDU.version_map.iterkeys(), reverse = True):
+
+        logging.debug("# Generating updates for protocol version %d", version)
+
+        current = rpki.rtr.server.read_current(version)[0]
+        expire_axfrs(version, current, args.keep_age, args.keep_count, args.keep_bytes)
+
+        pdus = rpki.rtr.generator.AXFRSet.from_extracted(version, serial, prefixes, routerkeys)
+        if digests is not None and version in digests:
+            current_digest = digests[version]
+        else:
+            current_digest = rpki.rtr.generator.AXFRSet.current_digest(version)
+        if pdus.digest() == current_digest:
+            logging.debug("# No change, new serial not needed")
+            continue
+        pdus.save_axfr()
+        pdus.save_ixfrs((axfr for axfr in glob.glob("*.ax.v%d" % version) if axfr != pdus.filename()),
+                        args.max_ixfr_ratio)
+        nonce = pdus.mark_current(args.force_zero_nonce)
+        if digests is not None:
+            digests[version] = pdus.digest()
+        changed += 1
+
+        logging.debug("# New serial is %d (%s)", pdus.serial, pdus.serial)
+
+        rpki.rtr.generator.kick_all(pdus.serial, nonce, version)
+
+        # Anything not leading to the new serial is stale, including
+        # IXFRs the server computed and saved for itself since last time.
+
+        old_ixfrs = [ixfr for ixfr in glob.glob("*.ix.*.v%d" % version) + glob.glob("*.nx.*.v%d" % version)
+                     if not ixfr.startswith("%d." % pdus.serial)]
+        old_ixfrs.sort()
+        for ixfr in old_ixfrs:
+            try:
+                logging.debug("# Deleting old file %s", ixfr)
+                os.unlink(ixfr)
+            except OSError:
+                pass
+
+    return changed
+
+
 def cronjob_main(args):
     """
     Run this right after running rcynic to wade through the ROAs and
@@ -502,6 +1128,10 @@ def cronjob_main(args):
     clients that a new version is available.
     """
 
+    cache = None
+    if args.vrp_cache:
+        cache = ExtractCache(os.path.abspath(args.vrp_cache))
+
     if args.rpki_rtr_dir:
         try:
             if not os.path.isdir(args.rpki_rtr_dir):
@@ -511,41 +1141,72 @@ def cronjob_main(args):
             logging.critical(str(e))
             sys.exit(1)
 
-    for version in sorted(rpki.rtr.server.PDU.version_map.iterkeys(), reverse = True):
+    generate(args, cache)
 
-        logging.debug("# Generating updates for protocol version %d", version)
+    if cache is not None:
+        cache.save()
 
-        old_ixfrs = glob.glob("*.ix.*.v%d" % version)
 
-        current = rpki.rtr.server.read_current(version)[0]
-        cutoff = Timestamp.now(-(24 * 60 * 60))
-        for f in glob.iglob("*.ax.v%d" % version):
-            t = Timestamp(int(f.split(".")[0]))
-            if  t < cutoff and t != current:
-                logging.debug("# Deleting old file %s, timestamp %s", f, t)
-                os.unlink(f)
-
-        pdus = rpki.rtr.generator.AXFRSet.parse_rcynic(args.rcynic_dir, version, args.scan_roas, args.scan_routercerts)
-        if pdus == rpki.rtr.generator.AXFRSet.load_current(version):
-            logging.debug("# No change, new serial not needed")
-            continue
-        pdus.save_axfr()
-        for axfr in glob.iglob("*.ax.v%d" % version):
-            if axfr != pdus.filename():
-                pdus.save_ixfr(rpki.rtr.generator.AXFRSet.load(axfr))
-        pdus.mark_current(args.force_zero_nonce)
+def generator_main(args):
+    """
+    Long-running alternative to cronjob: watch rcynic's output for the
+    end of each validation run, and update the RPKI-RTR database and
+    kick servers within seconds of it, rather than waiting for cron.
+    Between runs we keep the extraction cache and the digests of the
+    current AXFRs in memory, so each update only has to read the
+    objects which changed.  SIGHUP forces an update.
+    """
 
-        logging.debug("# New serial is %d (%s)", pdus.serial, pdus.serial)
+    # The extraction cache is only written to disk on exit, if at all.
 
-        rpki.rtr.generator.kick_all(pdus.serial)
+    cache = ExtractCache(os.path.abspath(args.vrp_cache) if args.vrp_cache else None)
 
-        old_ixfrs.sort()
-        for ixfr in old_ixfrs:
-            try:
-                logging.debug("# Deleting old file %s", ixfr)
-                os.unlink(ixfr)
-            except OSError:
-                pass
+    if args.rcynic_dir:
+        args.rcynic_dir = os.path.abspath(args.rcynic_dir)
+
+    if args.rpki_rtr_dir:
+        try:
+            if not os.path.isdir(args.rpki_rtr_dir):
+                os.makedirs(args.rpki_rtr_dir)
+            os.chdir(args.rpki_rtr_dir)
+        except OSError, e:
+            logging.critical(str(e))
+            sys.exit(1)
+
+    digests = {}
+    forced = []
+
+    def sighup(signum, frame):
+        forced.append(signum)
+
+    def sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGHUP, sighup)
+    signal.signal(signal.SIGTERM, sigterm)
+
+    generation = None
+
+    try:
+        while True:
+            g = authenticated_generation(args.rcynic_dir)
+            if forced or (g is not None and g != generation):
+                del forced[:]
+                generation = g
+                logging.debug("# Updating for rcynic output %r", g)
+                t = time.time()
+                try:
+                    changed = generate(args, cache, digests)
+                except Exception:
+                    logging.exception("# Update failed, waiting for rcynic output to change again")
+                else:
+                    logging.info("# Update took %.1f seconds, %d new serial(s)", time.time() - t, changed)
+            time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        cache.save()
 
 
 def show_main(args):
@@ -574,14 +1235,36 @@ def argparse_setup(subparsers):
     Set up argparse stuff for commands in this module.
     """
 
+    def add_generation_arguments(subparser):
+        subparser.add_argument("--scan-roas", help = "specify an external scan_roas program")
+        subparser.add_argument("--scan-routercerts", help = "specify an external scan_routercerts program")
+        subparser.add_argument("--force_zero_nonce", action = "store_true", help = "force nonce value of zero")
+        subparser.add_argument("--jobs", type = int, default = 1,
+                               help = "number of worker processes for extracting ROAs and router certificates")
+        subparser.add_argument("--vrp-cache",
+                               help = "filename for persistent cache of data extracted from ROAs and router certificates")
+        subparser.add_argument("--keep-age", type = int, default = 24 * 60 * 60,
+                               help = "maximum age in seconds of old AXFRs kept for generating IXFRs")
+        subparser.add_argument("--keep-count", type = int,
+                               help = "maximum number of old AXFRs kept for generating IXFRs")
+        subparser.add_argument("--keep-bytes", type = int,
+                               help = "maximum total size in bytes of old AXFRs kept for generating IXFRs")
+        subparser.add_argument("--max-ixfr-ratio", type = float,
+                               help = "skip IXFRs larger than this fraction of the AXFR, clients get a cache reset instead")
+        subparser.add_argument("rcynic_dir", nargs = "?", help = "directory containing validated rcynic output tree")
+        subparser.add_argument("rpki_rtr_dir", nargs = "?", help = "directory containing RPKI-RTR database")
+
     subparser = subparsers.add_parser("cronjob", description = cronjob_main.__doc__,
                                       help = "Generate RPKI-RTR database from rcynic output")
     subparser.set_defaults(func = cronjob_main, default_log_destination = "syslog")
-    subparser.add_argument("--scan-roas", help = "specify an external scan_roas program")
-    subparser.add_argument("--scan-routercerts", help = "specify an external scan_routercerts program")
-    subparser.add_argument("--force_zero_nonce", action = "store_true", help = "force nonce value of zero")
-    subparser.add_argument("rcynic_dir", nargs = "?", help = "directory containing validated rcynic output tree")
-    subparser.add_argument("rpki_rtr_dir", nargs = "?", help = "directory containing RPKI-RTR database")
+    add_generation_arguments(subparser)
+
+    subparser = subparsers.add_parser("generator", description = generator_main.__doc__,
+                                      help = "Keep RPKI-RTR database up to date with rcynic output")
+    subparser.set_defaults(func = generator_main, default_log_destination = "syslog")
+    subparser.add_argument("--poll-interval", type = float, default = 2,
+                           help = "seconds between checks for new rcynic output")
+    add_generation_arguments(subparser)
 
     subparser = subparsers.add_parser("show", description = show_main.__doc__,
                                       help = "Display content of RPKI-RTR database")
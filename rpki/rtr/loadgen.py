@@ -0,0 +1,266 @@
+# $Id$
+#
+# Copyright (C) 2015-2016  Parsons Government Services ("PARSONS")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notices and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND PARSONS DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS.  IN NO EVENT SHALL PARSONS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT
+# OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Load generator for the RPKI-RTR protocol (RFC 6810 et sequalia):
+many simulated routers talking to one server, for soak testing.
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import asyncore
+import collections
+import rpki.rtr.client
+
+from rpki.rtr.pdus import ResetQueryPDU, SerialQueryPDU, SerialNotifyPDU, CacheResetPDU, ErrorReportPDU
+
+
+class LoadStatistics(object):
+    """
+    Measurements collected from all the sessions in a load test.
+    """
+
+    def __init__(self):
+        self.transfers = { "reset" : [], "serial" : [], "notify" : [] }
+        self.transfer_bytes = { "reset" : [], "serial" : [], "notify" : [] }
+        self.notify_latency = []
+        self.notify_first_seen = {}
+        self.cache_resets = 0
+        self.error_reports = 0
+        self.sessions_closed = 0
+        self.total_bytes = 0
+        self.started = time.time()
+
+    def notified(self, serial, now):
+        """
+        Record arrival of a Serial Notify PDU.  Latency is measured from
+        the time the first session heard about the same serial number,
+        which is as close as we can get to the time the server did
+        without instrumenting the server.
+        """
+
+        first = self.notify_first_seen.setdefault(serial, now)
+        self.notify_latency.append(now - first)
+
+    def transferred(self, kind, seconds, nbytes):
+        """
+        Record a completed transfer.
+        """
+
+        self.transfers[kind].append(seconds)
+        self.transfer_bytes[kind].append(nbytes)
+
+    @staticmethod
+    def percentiles(values, points = (50, 90, 99, 100)):
+        """
+        Nearest-rank percentiles of a list of values.
+        """
+
+        values = sorted(values)
+        return [values[max(0, int(len(values) * p / 100.0 + 0.5) - 1)] for p in points]
+
+    def summary(self):
+        """
+        Generate lines of summary report.
+        """
+
+        elapsed = time.time() - self.started
+        yield "Elapsed %.1f seconds, %d bytes received (%.0f bytes/second), %d cache resets, %d error reports, %d sessions closed" % (
+            elapsed, self.total_bytes, self.total_bytes / max(elapsed, 0.001),
+            self.cache_resets, self.error_reports, self.sessions_closed)
+        yield "%-24s %7s %10s %10s %10s %10s" % ("", "count", "p50", "p90", "p99", "max")
+        for kind in ("reset", "serial", "notify"):
+            if self.transfers[kind]:
+                yield "%-24s %7d %10.4f %10.4f %10.4f %10.4f" % (
+                    ("%s: seconds to EOD" % kind, len(self.transfers[kind])) +
+                    tuple(self.percentiles(self.transfers[kind])))
+                yield "%-24s %7d %10d %10d %10d %10d" % (
+                    ("%s: bytes" % kind, len(self.transfer_bytes[kind])) +
+                    tuple(self.percentiles(self.transfer_bytes[kind])))
+        if self.notify_latency:
+            yield "%-24s %7d %10.4f %10.4f %10.4f %10.4f" % (
+                ("notify latency", len(self.notify_latency)) +
+                tuple(self.percentiles(self.notify_latency)))
+
+
+class LoadChannel(rpki.rtr.client.ClientChannel):
+    """
+    One simulated router.  Protocol handling is the ordinary client's;
+    we just watch the queries going out and the data coming back, and
+    close rather than exiting when something goes wrong.
+    """
+
+    stats = None
+    pending_notify = False
+    query_bytes = 0
+    next_query = None
+    next_reset = None
+
+    def __init__(self, *args, **kwargs):
+        self.queries = collections.deque()
+        super(LoadChannel, self).__init__(*args, **kwargs)
+
+    def collect_incoming_data(self, data):
+        self.query_bytes += len(data)
+        self.stats.total_bytes += len(data)
+        super(LoadChannel, self).collect_incoming_data(data)
+
+    def deliver_pdu(self, pdu):
+        """
+        Watch for PDUs which end a query without an End Of Data, and for
+        Serial Notifies, then hand the PDU to the normal client code.
+        """
+
+        if isinstance(pdu, SerialNotifyPDU):
+            self.stats.notified(pdu.serial, time.time())
+            self.pending_notify = True
+        elif isinstance(pdu, (CacheResetPDU, ErrorReportPDU)):
+            if isinstance(pdu, CacheResetPDU):
+                self.stats.cache_resets += 1
+            else:
+                self.stats.error_reports += 1
+            if self.queries:
+                self.queries.popleft()
+            self.query_bytes = 0
+        super(LoadChannel, self).deliver_pdu(pdu)
+
+    def push_pdu(self, pdu):
+        """
+        Start timing a transfer when we send a query.  Responses come
+        back in the order we sent the queries, so we just queue them.
+        Queries the client code sends in response to a Serial Notify
+        are counted as notify transfers.
+        """
+
+        if isinstance(pdu, (ResetQueryPDU, SerialQueryPDU)):
+            if self.pending_notify:
+                kind = "notify"
+            elif isinstance(pdu, ResetQueryPDU):
+                kind = "reset"
+            else:
+                kind = "serial"
+            self.pending_notify = False
+            self.queries.append((kind, time.time()))
+        super(LoadChannel, self).push_pdu(pdu)
+
+    def end_of_data(self, version, serial, nonce, refresh, retry, expire):
+        super(LoadChannel, self).end_of_data(version, serial, nonce, refresh, retry, expire)
+        if self.queries:
+            kind, started = self.queries.popleft()
+            self.stats.transferred(kind, time.time() - started, self.query_bytes)
+        self.query_bytes = 0
+
+    def poll(self, now):
+        """
+        Send a query if one is due and we're not already waiting for
+        one.  We ignore the server's refresh timer, our schedule comes
+        from the command line.
+        """
+
+        if self.queries or not self.connected or now < self.next_query:
+            return
+        if self.serial is None or self.nonce is None or now >= self.next_reset:
+            self.push_pdu(ResetQueryPDU(version = self.version))
+            self.next_reset = now + self.args.reset_interval
+        else:
+            self.push_pdu(SerialQueryPDU(version = self.version, serial = self.serial, nonce = self.nonce))
+        self.next_query = now + self.args.query_interval
+
+    def handle_close(self):
+        logging.info("[Session %s closed by server]", id(self))
+        self.stats.sessions_closed += 1
+        self.close()
+        self.cleanup()
+
+    def handle_error(self):
+        logging.exception("[Unhandled exception in session %s, closing]", id(self))
+        self.stats.sessions_closed += 1
+        self.close()
+        self.cleanup()
+
+
+def loadgen_main(args):
+    """
+    Load generator for testing RPKI-RTR servers: open many concurrent
+    client sessions, send reset and serial queries on a schedule, follow
+    serial notifies, and report how long transfers took.  Uses the
+    ordinary client protocol code, but keeps no sqlite database.  The
+    report is logged at level info, so run with --log-level info to see it.
+    """
+
+    if args.rpki_rtr_dir:
+        try:
+            os.chdir(args.rpki_rtr_dir)
+        except OSError, e:
+            sys.exit(e)
+
+    stats = LoadStatistics()
+    constructor = getattr(LoadChannel, args.protocol)
+    sessions = []
+
+    try:
+        for i in xrange(args.sessions):
+            session = constructor(args)
+            session.stats = stats
+            session.next_query = time.time() + random.uniform(0, args.ramp)
+            session.next_reset = session.next_query + args.reset_interval
+            sessions.append(session)
+
+        logging.info("[Started %d sessions]", len(sessions))
+        stop = time.time() + args.duration
+
+        while time.time() < stop:
+            now = time.time()
+            for session in sessions:
+                session.poll(now)
+            asyncore.loop(timeout = 0.1, count = 1, use_poll = True)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        for session in sessions:
+            session.cleanup()
+
+    for line in stats.summary():
+        logging.info(line)
+
+
+def argparse_setup(subparsers):
+    """
+    Set up argparse stuff for commands in this module.
+    """
+
+    subparser = subparsers.add_parser("loadgen", description = loadgen_main.__doc__,
+                                      help = "load generator for RPKI-RTR servers")
+    subparser.set_defaults(func = loadgen_main, default_log_destination = "stderr",
+                           sql_database = None, sql_bulk_load = False, reset_session = False)
+    subparser.add_argument("--sessions", type = int, default = 10, help = "number of concurrent sessions")
+    subparser.add_argument("--duration", type = float, default = 60, help = "seconds to run before reporting")
+    subparser.add_argument("--ramp", type = float, default = 0, help = "spread initial reset queries over this many seconds")
+    subparser.add_argument("--query-interval", type = float, default = 10, help = "seconds between queries in each session")
+    subparser.add_argument("--reset-interval", type = float, default = 3600,
+                           help = "seconds between reset queries (other queries are serial queries)")
+    subparser.add_argument("--force-version", type = int, choices = rpki.rtr.client.PDU.version_map,
+                           help = "force specific protocol version")
+    subparser.add_argument("--rpki-rtr-dir", help = "directory containing RPKI-RTR database (loopback protocol)")
+    subparser.add_argument("protocol", choices = ("loopback", "tcp"), help = "connection protocol")
+    subparser.add_argument("host", nargs = "?", help = "server host")
+    subparser.add_argument("port", nargs = "?", help = "server port")
+    return subparser
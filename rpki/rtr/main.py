@@ -37,6 +37,7 @@ def main():
 
     from rpki.rtr.server    import argparse_setup as argparse_setup_server
     from rpki.rtr.client    import argparse_setup as argparse_setup_client
+    from rpki.rtr.loadgen   import argparse_setup as argparse_setup_loadgen
     from rpki.rtr.generator import argparse_setup as argparse_setup_generator
 
     if "rpki.rtr.bgpdump" in sys.modules:
@@ -51,6 +52,7 @@ def main():
     subparsers = cfg.argparser.add_subparsers(title = "Commands", metavar = "", dest = "mode")
     argparse_setup_server(subparsers)
     argparse_setup_client(subparsers)
+    argparse_setup_loadgen(subparsers)
     argparse_setup_generator(subparsers)
     argparse_setup_bgpdump(subparsers)
     args = cfg.argparser.parse_args()
@@ -0,0 +1,226 @@
+# $Id$
+#
+# Copyright (C) 2015-2016  Parsons Government Services ("PARSONS")
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notices and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND PARSONS DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS.  IN NO EVENT SHALL PARSONS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT
+# OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+In-process metrics for the RPKI-RTR server, exported as text in the
+Prometheus exposition format.
+"""
+
+import os
+import json
+import bisect
+
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram.  counts[i] is the number of observations no
+    greater than buckets[i] and greater than buckets[i - 1]; the last
+    count is everything greater than the last bucket.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        assert self.buckets == other.buckets
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.sum += other.sum
+
+
+class ServerMetrics(object):
+    """
+    Counters and histograms for one server process.  In forked mode,
+    each server sends snapshots of its metrics up to the listener, which
+    merges them; see snapshot() and merge().
+
+    sessions_active is a gauge, not a counter, so merge() leaves it
+    alone; it's only set on metrics which came from a snapshot, or from
+    ChildMetrics.total().
+    """
+
+    sessions_active = None
+
+    counter_help = {
+        "rpki_rtr_sessions_total"         : "Sessions started.",
+        "rpki_rtr_queries_total"          : "Queries received, by type.",
+        "rpki_rtr_responses_total"        : "Responses sent, by type.",
+        "rpki_rtr_ixfr_computed_total"    : "IXFRs computed on demand because there was no IXFR file.",
+        "rpki_rtr_notifies_total"         : "Serial Notify PDUs sent.",
+        "rpki_rtr_error_reports_total"    : "Error Report PDUs received from clients.",
+        "rpki_rtr_stalled_sessions_total" : "Sessions dropped because the client stopped reading.",
+        "rpki_rtr_bytes_sent_total"       : "Bytes sent to clients." }
+
+    histogram_help = {
+        "rpki_rtr_serve_seconds"          : "Time from receiving a query to queuing the complete response.",
+        "rpki_rtr_serial_lag_seconds"     : "How far behind the current serial number clients' serial queries were." }
+
+    histogram_buckets = {
+        "rpki_rtr_serve_seconds"          : (0.0001, 0.001, 0.01, 0.1, 1, 10),
+        "rpki_rtr_serial_lag_seconds"     : (0, 60, 300, 900, 3600, 4 * 3600, 86400) }
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = dict((name, Histogram(buckets)) for name, buckets in self.histogram_buckets.iteritems())
+
+    def count(self, name, label = None, n = 1):
+        """
+        Increment a counter.  Counters have at most one label, "type".
+        """
+
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, value):
+        """
+        Add an observation to a histogram.
+        """
+
+        self.histograms[name].observe(value)
+
+    def merge(self, other):
+        """
+        Add another set of metrics into this one.
+        """
+
+        for key, n in other.counters.iteritems():
+            self.counters[key] = self.counters.get(key, 0) + n
+        for name, h in other.histograms.iteritems():
+            self.histograms[name].merge(h)
+
+    def snapshot(self, sessions_active = None):
+        """
+        Serialize these metrics for sending to the listener, along with
+        the sender's count of open sessions, if it has one.
+        """
+
+        return json.dumps(dict(counters = [(name, label, n) for (name, label), n in self.counters.iteritems()],
+                               histograms = dict((name, (h.counts, h.sum)) for name, h in self.histograms.iteritems()),
+                               sessions_active = sessions_active))
+
+    @classmethod
+    def from_snapshot(cls, data):
+        """
+        Reconstruct metrics from the output of snapshot().
+        """
+
+        self = cls()
+        d = json.loads(data)
+        for name, label, n in d["counters"]:
+            self.counters[(str(name), None if label is None else str(label))] = n
+        for name, (counts, total) in d["histograms"].iteritems():
+            h = self.histograms[str(name)]
+            h.counts = list(counts)
+            h.sum = total
+        self.sessions_active = d.get("sessions_active")
+        return self
+
+    def format(self, sessions_active = None):
+        """
+        Generate Prometheus text format for these metrics.
+        """
+
+        if sessions_active is None:
+            sessions_active = self.sessions_active
+        lines = []
+        if sessions_active is not None:
+            lines.append("# HELP rpki_rtr_sessions_active Sessions currently open.")
+            lines.append("# TYPE rpki_rtr_sessions_active gauge")
+            lines.append("rpki_rtr_sessions_active %d" % sessions_active)
+        for name in sorted(self.counter_help):
+            lines.append("# HELP %s %s" % (name, self.counter_help[name]))
+            lines.append("# TYPE %s counter" % name)
+            values = sorted((label, n) for (k, label), n in self.counters.iteritems() if k == name)
+            if not values:
+                values = [(None, 0)]
+            for label, n in values:
+                if label is None:
+                    lines.append("%s %d" % (name, n))
+                else:
+                    lines.append("%s{type=\"%s\"} %d" % (name, label, n))
+        for name in sorted(self.histogram_help):
+            h = self.histograms[name]
+            lines.append("# HELP %s %s" % (name, self.histogram_help[name]))
+            lines.append("# TYPE %s histogram" % name)
+            n = 0
+            for bound, count in zip(h.buckets, h.counts):
+                n += count
+                lines.append("%s_bucket{le=\"%s\"} %d" % (name, bound, n))
+            n += h.counts[-1]
+            lines.append("%s_bucket{le=\"+Inf\"} %d" % (name, n))
+            lines.append("%s_sum %s" % (name, repr(h.sum)))
+            lines.append("%s_count %d" % (name, n))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename, sessions_active = None):
+        """
+        Write metrics to a text file, replacing it atomically, which is
+        what node_exporter's textfile collector and similar tools want.
+        """
+
+        tmp = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(self.format(sessions_active))
+        os.rename(tmp, filename)
+
+
+class ChildMetrics(object):
+    """
+    Metrics a listener collects from the processes it forks: the latest
+    snapshot from each live child, plus totals for children which have
+    exited.
+    """
+
+    def __init__(self):
+        self.live = {}
+        self.retired = ServerMetrics()
+
+    def update(self, pid, metrics):
+        """
+        Record a new snapshot from a child.  metrics may be None, in
+        which case we keep what we had.
+        """
+
+        if metrics is not None:
+            self.live[pid] = metrics
+
+    def retire(self, pid):
+        """
+        Fold a child which has exited into the retired totals.
+        """
+
+        if pid in self.live:
+            self.retired.merge(self.live.pop(pid))
+
+    def total(self):
+        """
+        Return the sum of retired and live metrics.  Open sessions are
+        summed over live children which reported them.
+        """
+
+        metrics = ServerMetrics()
+        metrics.merge(self.retired)
+        for m in self.live.itervalues():
+            metrics.merge(m)
+            if m.sessions_active is not None:
+                metrics.sessions_active = (metrics.sessions_active or 0) + m.sessions_active
+        return metrics
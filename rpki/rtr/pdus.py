@@ -145,7 +145,7 @@ class PDU(object):
         if not reader.ready():
             return None
         assert reader.available() >= cls.header_struct.size
-        version, pdu_type, length = cls.header_struct.unpack(reader.buffer[:cls.header_struct.size])
+        version, pdu_type, length = reader.peek(cls.header_struct)
         reader.check_version(version)
         if pdu_type not in cls.version_map[version]:
             raise UnsupportedPDUType(
@@ -427,6 +427,7 @@ class PrefixPDU(PDU):
     header_struct = struct.Struct("!BB2xLBBBx")
     asnum_struct = struct.Struct("!L")
     address_byte_count = 0
+    announce_offset = 8                   # Offset of flags byte in wire format
 
     def __init__(self, version):
         super(PrefixPDU, self).__init__(version)
@@ -437,9 +438,19 @@ class PrefixPDU(PDU):
         self.announce = None
 
     def __str__(self):
-        plm = "%s/%s-%s" % (self.prefix, self.prefixlen, self.max_prefixlen)
-        return "%s %8s  %-32s %s" % ("+" if self.announce else "-", self.asn, plm,
-                                     ":".join(("%02X" % ord(b) for b in self.to_pdu())))
+        return self.format_prefix(self.announce, self.asn, self.prefix,
+                                  self.prefixlen, self.max_prefixlen, self.to_pdu())
+
+    @staticmethod
+    def format_prefix(announce, asn, prefix, prefixlen, max_prefixlen, pdu):
+        """
+        Text form of a prefix, shared by __str__() and code which has
+        the fields without a PDU object (see decode_pdus()).
+        """
+
+        plm = "%s/%s-%s" % (prefix, prefixlen, max_prefixlen)
+        return "%s %8s  %-32s %s" % ("+" if announce else "-", asn, plm,
+                                     ":".join(("%02X" % ord(b) for b in pdu)))
 
     def show(self):
         logging.debug("# Class:        %s", self.__class__.__name__)
@@ -510,6 +521,7 @@ class IPv4PrefixPDU(PrefixPDU):
 
     pdu_type = 4
     address_byte_count = 4
+    record_struct = struct.Struct("!BB2xLBBBx4sL")
 
 @wire_pdu
 class IPv6PrefixPDU(PrefixPDU):
@@ -519,6 +531,7 @@ class IPv6PrefixPDU(PrefixPDU):
 
     pdu_type = 6
     address_byte_count = 16
+    record_struct = struct.Struct("!BB2xLBBBx16sL")
 
 @wire_pdu_only(1)
 class RouterKeyPDU(PDU):
@@ -529,6 +542,7 @@ class RouterKeyPDU(PDU):
     pdu_type = 9
 
     header_struct = struct.Struct("!BBBxL20sL")
+    announce_offset = 2                   # Offset of flags byte in wire format
 
     def __init__(self, version):
         super(RouterKeyPDU, self).__init__(version)
@@ -675,3 +689,74 @@ class ErrorReportPDU(PDU):
                 + self.to_counted_string(self.errmsg.encode("utf8"))
                 == self.to_pdu())
         return self
+
+
+# Bulk decoding
+
+_batch_structs = {}
+
+def decode_pdus(buf, version, start = 0, end = None, root_pdu_class = None, batch = 256):
+    """
+    Decode a buffer full of PDUs (an AXFR or IXFR file, mmap()ed or read
+    into a string, or a chunk of data received from the wire) in one
+    pass, without going through a ReadBuffer and a PDU object for each
+    record.
+
+    Prefix PDUs are fixed-length, so we unpack them in runs of up to
+    batch records with a single struct call, and return each as a
+    compact (announce, asn, address, prefixlen, max_prefixlen) tuple,
+    address being the raw bytes.  Everything else (router keys, error
+    reports, ...) falls back to normal per-PDU decoding and comes back
+    as a PDU object of the appropriate subclass of root_pdu_class.
+
+    The buffer must end on a PDU boundary; anything else is CorruptData.
+    """
+
+    if root_pdu_class is None:
+        root_pdu_class = PDU
+    if end is None:
+        end = len(buf)
+    version_map = root_pdu_class.version_map[version]
+    header_struct = PDU.header_struct
+    i = start
+    while i < end:
+        if end - i < header_struct.size:
+            raise CorruptData("Truncated PDU header")
+        v, pdu_type, length = header_struct.unpack_from(buf, i)
+        if v != version:
+            raise CorruptData("Received PDU version %d, expected %d" % (v, version))
+        if pdu_type not in version_map:
+            raise UnsupportedPDUType("Received unsupported PDU type %d" % pdu_type)
+        if length < header_struct.size or i + length > end:
+            raise CorruptData("Received PDU with bad length %d" % length)
+        cls = version_map[pdu_type]
+        record_struct = getattr(cls, "record_struct", None)
+        if record_struct is None:
+            import rpki.rtr.channels
+            r = rpki.rtr.channels.ReadBuffer()
+            r.put(buf[i : i + length])
+            p = root_pdu_class.read_pdu(r)
+            assert p is not None and r.available() == 0
+            yield p
+            i += length
+            continue
+        size = record_struct.size
+        bits = cls.address_byte_count * 8
+        if length != size:
+            raise CorruptData("Got PDU length %d, expected %d" % (length, size))
+        n = min(batch, (end - i) // size)
+        key = (record_struct.format, n)
+        batch_struct = _batch_structs.get(key)
+        if batch_struct is None:
+            batch_struct = _batch_structs[key] = struct.Struct("!" + record_struct.format[1:] * n)
+        fields = batch_struct.unpack_from(buf, i)
+        for j in xrange(0, len(fields), 8):
+            v, t, length, announce, prefixlen, max_prefixlen, address, asn = fields[j : j + 8]
+            if v != version or t != pdu_type or length != size:
+                break
+            if announce not in (0, 1):
+                raise CorruptData("Announce value %d is neither zero nor one" % announce)
+            if prefixlen > bits or max_prefixlen < prefixlen or max_prefixlen > bits:
+                raise CorruptData("Implausible prefix lengths %d-%d" % (prefixlen, max_prefixlen))
+            yield announce, asn, address, prefixlen, max_prefixlen
+            i += size
@@ -23,15 +23,22 @@ Server implementation for the RPKI-RTR protocol (RFC 6810 et sequalia).
 
 import os
 import sys
+import time
+import mmap
 import errno
 import socket
 import signal
+import select
 import logging
+import threading
+import collections
 import asyncore
+import asynchat
 import rpki.POW
 import rpki.oids
 import rpki.rtr.pdus
 import rpki.rtr.channels
+import rpki.rtr.metrics
 
 from rpki.rtr.pdus import (clone_pdu_root, CacheResponsePDU, EndOfDataPDU, CacheResetPDU, SerialNotifyPDU)
 
@@ -57,7 +64,7 @@ class PDU(rpki.rtr.pdus.PDU):
         fn2 = os.path.splitext(filename)[1]
         assert fn2.startswith(".v") and fn2[2:].isdigit() and int(fn2[2:]) == server.version
 
-        f = open(filename, "rb")
+        f = server.open_file(filename)
         server.push_pdu(CacheResponsePDU(version = server.version,
                                          nonce   = server.current_nonce))
         server.push_file(f)
@@ -73,10 +80,19 @@ class PDU(rpki.rtr.pdus.PDU):
         Send a nodata error.
         """
 
+        server.metrics.count("rpki_rtr_responses_total", "no_data")
         server.push_pdu(ErrorReportPDU(version = server.version,
                                        errno = ErrorReportPDU.codes["No Data Available"],
                                        errpdu = self))
 
+    def send_cache_reset(self, server):
+        """
+        Send a cache reset.
+        """
+
+        server.metrics.count("rpki_rtr_responses_total", "cache_reset")
+        server.push_pdu(CacheResetPDU(version = server.version))
+
 
 clone_pdu = clone_pdu_root(PDU)
 
@@ -95,13 +111,18 @@ class SerialQueryPDU(PDU, rpki.rtr.pdus.SerialQueryPDU):
         """
 
         server.logger.debug(self)
+        server.metrics.count("rpki_rtr_queries_total", "serial")
         if server.get_serial() is None:
             self.send_nodata(server)
-        elif server.current_nonce != self.nonce:
+            return
+        if server.current_nonce != self.nonce:
             server.logger.info("[Client requested wrong nonce, resetting client]")
-            server.push_pdu(CacheResetPDU(version = server.version))
-        elif server.current_serial == self.serial:
+            self.send_cache_reset(server)
+            return
+        server.metrics.observe("rpki_rtr_serial_lag_seconds", max(0, server.current_serial - self.serial))
+        if server.current_serial == self.serial:
             server.logger.debug("[Client is already current, sending empty IXFR]")
+            server.metrics.count("rpki_rtr_responses_total", "empty")
             server.push_pdu(CacheResponsePDU(version = server.version,
                                              nonce   = server.current_nonce))
             server.push_pdu(EndOfDataPDU(version = server.version,
@@ -111,12 +132,45 @@ class SerialQueryPDU(PDU, rpki.rtr.pdus.SerialQueryPDU):
                                          retry   = server.retry,
                                          expire  = server.expire))
         elif disable_incrementals:
-            server.push_pdu(CacheResetPDU(version = server.version))
+            self.send_cache_reset(server)
         else:
-            try:
-                self.send_file(server, "%d.ix.%d.v%d" % (server.current_serial, self.serial, server.version))
-            except IOError:
-                server.push_pdu(CacheResetPDU(version = server.version))
+            self.serve_ixfr(server)
+
+    def serve_ixfr(self, server):
+        """
+        Send the incremental transfer, or a cache reset if we can't.  If
+        the server has to wait for the IXFR to be computed, it calls us
+        again when it's ready, and we return False.
+        """
+
+        try:
+            self.send_ixfr(server)
+        except IXFRPending:
+            server.wait_ixfr(self)
+            return False
+        except IOError:
+            self.send_cache_reset(server)
+        else:
+            server.metrics.count("rpki_rtr_responses_total", "ixfr")
+        return True
+
+    def send_ixfr(self, server):
+        """
+        Send the incremental transfer from the client's serial number to
+        the current one, computing it if we don't have an IXFR file for
+        it.  Caller should catch IOError and IXFRPending.
+        """
+
+        f = server.open_ixfr(self.serial)
+        server.push_pdu(CacheResponsePDU(version = server.version,
+                                         nonce   = server.current_nonce))
+        server.push_file(f)
+        server.push_pdu(EndOfDataPDU(version = server.version,
+                                     serial  = server.current_serial,
+                                     nonce   = server.current_nonce,
+                                     refresh = server.refresh,
+                                     retry   = server.retry,
+                                     expire  = server.expire))
 
 
 @clone_pdu
@@ -131,13 +185,16 @@ class ResetQueryPDU(PDU, rpki.rtr.pdus.ResetQueryPDU):
         """
 
         server.logger.debug(self)
+        server.metrics.count("rpki_rtr_queries_total", "reset")
         if server.get_serial() is None:
             self.send_nodata(server)
         else:
             try:
                 fn = "%d.ax.v%d" % (server.current_serial, server.version)
                 self.send_file(server, fn)
+                server.metrics.count("rpki_rtr_responses_total", "axfr")
             except IOError:
+                server.metrics.count("rpki_rtr_responses_total", "error")
                 server.push_pdu(ErrorReportPDU(version = server.version,
                                                errno   = ErrorReportPDU.codes["Internal Error"],
                                                errpdu  = self,
@@ -157,9 +214,10 @@ class ErrorReportPDU(rpki.rtr.pdus.ErrorReportPDU):
         """
 
         server.logger.error(self)
+        server.metrics.count("rpki_rtr_error_reports_total")
         if self.errno in self.fatal:
             server.logger.error("[Shutting down due to reported fatal protocol error]")
-            sys.exit(1)
+            server.exit(1)
 
 
 def read_current(version):
@@ -173,37 +231,449 @@ def read_current(version):
         return None, None
     try:
         with open("current.v%d" % version, "r") as f:
-            values = tuple(int(s) for s in f.read().split())
-        return values[0], values[1]
+            values = f.read().split()
+        return int(values[0]), int(values[1])
     except IndexError:
-        return values[0], 0
+        return int(values[0]), 0
     except IOError:
         return None, None
 
 
-def write_current(serial, nonce, version):
+def read_current_digest(version):
     """
-    Write serial number and nonce.
+    Read content digest of the current AXFR, if recorded.  Return None
+    if not recorded, which includes files written by older versions of
+    this code and by the bgpdump simulator.
+    """
+
+    try:
+        with open("current.v%d" % version, "r") as f:
+            values = f.read().split()
+        return values[2]
+    except (IndexError, IOError):
+        return None
+
+
+def write_current(serial, nonce, version, digest = None):
+    """
+    Write serial number, nonce, and (optionally) content digest of the
+    current AXFR.
     """
 
     curfn = "current.v%d" % version
     tmpfn = curfn + "%d.tmp" % os.getpid()
     with open(tmpfn, "w") as f:
-        f.write("%d %d\n" % (serial, nonce))
+        if digest is None:
+            f.write("%d %d\n" % (serial, nonce))
+        else:
+            f.write("%d %d %s\n" % (serial, nonce, digest))
     os.rename(tmpfn, curfn)
 
 
-class FileProducer(object):
+def format_kick(serial, nonce = None, version = None):
+    """
+    Construct the message cronjob mode sends to kick servers.  If we
+    know the nonce and protocol version, we include them, along with the
+    serial number, so that servers don't have to go read current.v*.
+    """
+
+    if nonce is None or version is None:
+        return "Good morning, serial %d is ready" % serial
+    return "Good morning, serial %d nonce %d version %d is ready" % (serial, nonce, version)
+
+
+def parse_kick(data):
+    """
+    Parse a kick message.  Return a (version, serial, nonce) tuple, or
+    None if the message doesn't tell us all three, in which case the
+    caller should fall back to read_current().
+    """
+
+    try:
+        words = data.split()
+        return tuple(int(words[words.index(w) + 1]) for w in ("version", "serial", "nonce"))
+    except (ValueError, IndexError, AttributeError):
+        return None
+
+
+def map_file(filename):
+    """
+    Map an AXFR or IXFR file read-only into memory, so that we can serve
+    it without reading it into Python strings.  The pages come straight
+    from the kernel's page cache, and are shared with every other
+    process serving the same file.  Caller should catch IOError.
+    """
+
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+
+class IXFRPending(Exception):
+    """
+    The IXFR a session asked for is still being computed.
+    """
+
+
+def check_ixfr_skipped(serial, old_serial, version):
+    """
+    Raise IOError if the cronjob decided the IXFR from old_serial to
+    serial was too large to be worth keeping (--max-ixfr-ratio), in
+    which case the client should get a Cache Reset, not an IXFR we
+    computed ourselves.
+    """
+
+    filename = "%d.nx.%d.v%d" % (serial, old_serial, version)
+    if os.path.exists(filename):
+        raise IOError(errno.ENOENT, "IXFR skipped by cronjob as too large", filename)
+
+
+def compute_ixfr(serial, old_serial, version):
+    """
+    Compute the IXFR from old_serial to serial from the AXFR files for
+    both serials, for when the cronjob didn't leave us an IXFR file (eg,
+    we're still serving the serial it just replaced).  We save the
+    result as an IXFR file if we can, so that other server processes
+    don't have to compute it again; the cronjob cleans these up along
+    with its own.  Caller should call check_ixfr_skipped() first, and
+    should catch IOError.
+    """
+
+    import rpki.rtr.generator
+    new = rpki.rtr.generator.AXFRSet.load("%d.ax.v%d" % (serial, version))
+    old = rpki.rtr.generator.AXFRSet.load("%d.ax.v%d" % (old_serial, version))
+    data = "".join(new.ixfr_records(old))
+    filename = "%d.ix.%d.v%d" % (serial, old_serial, version)
+    tmp = ".%s.%d.%d.tmp" % (filename, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.rename(tmp, filename)
+    except (IOError, OSError), e:
+        logging.debug("[Couldn't save computed IXFR %s: %s]", filename, e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+    return data
+
+
+class IXFRCache(object):
+    """
+    Least-recently-used cache of IXFRs we've computed on demand, keyed
+    by (old serial, new serial, version), so that a wave of routers
+    coming back at the same stale serial number costs us one diff
+    rather than one per router.  Bounded by total size, not by count,
+    since IXFRs vary in size by orders of magnitude.
+
+    Computing an IXFR means loading two AXFRs, which would stall every
+    other session in an event-driven server, so we do it in a
+    background thread.  Sessions which ask for an IXFR while we're
+    computing it wait for it, and get called back when it's done.  The
+    thread just leaves its result in a queue and wakes up the event loop
+    (see IXFRWakeupChannel); everything else happens in the event loop.
+    """
+
+    def __init__(self, max_bytes = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.waiters = {}
+        self.done = collections.deque()
+        self.wakeup = IXFRWakeupChannel(self)
+
+    def get(self, serial, old_serial, version):
+        """
+        Return the IXFR from old_serial to serial if we have it, or None.
+        """
+
+        key = (old_serial, serial, version)
+        data = self.entries.pop(key, None)
+        if data is not None:
+            self.entries[key] = data
+        return data
+
+    def compute(self, serial, old_serial, version):
+        """
+        Start computing the IXFR from old_serial to serial, unless we're
+        already doing so.  Returns True if we started a computation.
+        """
+
+        key = (old_serial, serial, version)
+        if key in self.waiters:
+            return False
+        self.waiters[key] = []
+        thread = threading.Thread(target = self.run, args = key)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def wait(self, serial, old_serial, version, callback):
+        """
+        Call callback when we finish computing the IXFR from old_serial
+        to serial, which we must already be doing.  callback gets the
+        IXFR, or None if we couldn't compute it.
+        """
+
+        self.waiters[(old_serial, serial, version)].append(callback)
+
+    def run(self, old_serial, serial, version):
+        """
+        Background thread body for compute().
+        """
+
+        try:
+            data = compute_ixfr(serial, old_serial, version)
+        except Exception, e:
+            logging.warning("[Couldn't compute IXFR from serial %d to %d: %s]", old_serial, serial, e)
+            data = None
+        self.done.append(((old_serial, serial, version), data))
+        self.wakeup.wake()
+
+    def finish(self):
+        """
+        Called from the event loop when computations have finished:
+        cache the results, and call back the sessions waiting for them.
+        """
+
+        while self.done:
+            key, data = self.done.popleft()
+            if data is not None:
+                self.entries[key] = data
+                self.size += len(data)
+                while self.size > self.max_bytes and len(self.entries) > 1:
+                    self.size -= len(self.entries.popitem(last = False)[1])
+            for callback in self.waiters.pop(key, ()):
+                try:
+                    callback(data)
+                except Exception:
+                    logging.exception("[Unhandled exception delivering computed IXFR]")
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class IXFRWakeupChannel(asyncore.dispatcher, object):
+    """
+    asyncore dispatcher for the socketpair IXFRCache's background
+    threads use to wake up the event loop when they're done.
+    """
+
+    def __init__(self, cache):
+        sock, self.trigger = socket.socketpair()
+        asyncore.dispatcher.__init__(self, sock)            # Old-style class
+        self.trigger.setblocking(0)
+        self.cache = cache
+
+    def wake(self):
+        """
+        Wake up the event loop.  Called from background threads.  If
+        the socket buffer is full, the loop has a wakeup pending anyway.
+        """
+
+        try:
+            self.trigger.send("x")
+        except socket.error:
+            pass
+
+    def writable(self):
+        """
+        This socket is read-only, never writable.
+        """
+
+        return False
+
+    def handle_read(self):
+        """
+        Something finished, go deal with it.
+        """
+
+        self.recv(512)
+        self.cache.finish()
+
+    def log(self, msg):
+        """
+        Intercept asyncore's logging.
+        """
+
+        logging.info(msg)
+
+    def log_info(self, msg, tag = "info"):
+        """
+        Intercept asyncore's logging.
+        """
+
+        logging.info("asyncore: %s: %s", tag, msg)
+
+    def handle_error(self):
+        """
+        Handle errors caught by asyncore main loop.
+        """
+
+        logging.exception("[Unhandled exception handling computed IXFRs]")
+
+
+class BufferProducer(object):
     """
-    File-based producer object for asynchat.
+    Producer object for asynchat serving in-memory or mapped data,
+    possibly shared with other sessions.  We hand out buffer objects
+    rather than slices, so the data isn't copied just to queue it.
+    asynchat only asks for more when the socket is writable, so a
+    slow client just leaves us sitting at an offset in shared data.
     """
 
-    def __init__(self, handle, buffersize):
-        self.handle = handle
+    def __init__(self, data, buffersize):
+        self.data = data
         self.buffersize = buffersize
+        self.offset = 0
 
     def more(self):
-        return self.handle.read(self.buffersize)
+        b = buffer(self.data, self.offset, self.buffersize)
+        self.offset += len(b)
+        return b
+
+    def remaining(self):
+        return len(self.data) - self.offset
+
+
+class ServerDatabase(object):
+    """
+    In-memory view of the RPKI-RTR database, shared by all the sessions
+    in an event-driven server process: current serial number and nonce
+    for each protocol version, and read-only mappings of the AXFR and
+    IXFR files we've served, so that we open each file once rather than
+    once per session.  Cached mappings are dropped when the serial
+    changes; sessions still sending from an old mapping keep it alive
+    until they finish.  IXFRs we had to compute ourselves live in an
+    IXFRCache, which outlives serial changes but is bounded in size.
+    """
+
+    # How often (in seconds) to check for a new serial number on our
+    # own, in case we somehow missed a kick from the cronjob.
+    poll_interval = 60
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.current = {}
+        self.files = {}
+        self.ixfrs = IXFRCache()
+        self.metrics = rpki.rtr.metrics.ServerMetrics()
+        self.sessions = set()
+        self.last_checked = rpki.rtr.channels.Timestamp.now()
+
+    def get_current(self, version):
+        """
+        Return current serial number and nonce for a protocol version.
+        """
+
+        if version is None:
+            return None, None
+        if version not in self.current:
+            self.current[version] = read_current(version)
+        return self.current[version]
+
+    def read_file(self, filename):
+        """
+        Return content of an AXFR or IXFR file, reading it if we don't
+        already have it.  Caller should catch IOError.
+        """
+
+        data = self.files.get(filename)
+        if data is None:
+            data = self.files[filename] = map_file(filename)
+        return data
+
+    def read_ixfr(self, serial, old_serial, version):
+        """
+        Return content of the IXFR from old_serial to serial, from its
+        file if we have one, otherwise from the IXFRCache.  If the cache
+        doesn't have it yet, we start computing it, unless we already
+        have, and raise IXFRPending; the caller can then wait for it
+        (see IXFRCache.wait()).  Caller should catch IOError and
+        IXFRPending.
+        """
+
+        try:
+            return self.read_file("%d.ix.%d.v%d" % (serial, old_serial, version))
+        except IOError:
+            pass
+        check_ixfr_skipped(serial, old_serial, version)
+        data = self.ixfrs.get(serial, old_serial, version)
+        if data is not None:
+            return data
+        if self.ixfrs.compute(serial, old_serial, version):
+            self.logger.debug("[No IXFR file from serial %d to %d, computing one]", old_serial, serial)
+            self.metrics.count("rpki_rtr_ixfr_computed_total")
+        raise IXFRPending("IXFR from serial %d to %d not ready yet" % (old_serial, serial))
+
+    def preload(self):
+        """
+        Map the current AXFR for every protocol version we speak, so
+        that the first session to ask for one doesn't wait for it.
+        """
+
+        for version in rpki.rtr.pdus.PDU.version_map:
+            serial, nonce = self.get_current(version)
+            if serial is None:
+                continue
+            try:
+                self.read_file("%d.ax.v%d" % (serial, version))
+            except IOError, e:
+                self.logger.warning("[Couldn't preload AXFR for version %d: %s]", version, e)
+
+    def check_current(self):
+        """
+        Re-read current serial numbers and nonces for all the protocol
+        versions we know about.  Return the set of versions for which
+        something changed.
+        """
+
+        self.last_checked = rpki.rtr.channels.Timestamp.now()
+        changed = set()
+        for version in self.current.keys():
+            current = read_current(version)
+            if current != self.current[version]:
+                self.current[version] = current
+                changed.add(version)
+        if changed:
+            self.files.clear()
+        return changed
+
+    def notify(self, data = None):
+        """
+        Cronjob instance kicked us: check whether serial numbers have
+        changed, and tell any sessions running affected protocol
+        versions to send notify messages.
+        """
+
+        kick = parse_kick(data)
+        if kick is None:
+            changed = self.check_current()
+        else:
+            version, serial, nonce = kick
+            self.last_checked = rpki.rtr.channels.Timestamp.now()
+            changed = set() if self.current.get(version) == (serial, nonce) else set((version,))
+            self.current[version] = (serial, nonce)
+            if changed:
+                self.files.clear()
+        if not changed:
+            self.logger.debug("Cronjob kicked me but I see no serial change, ignoring")
+        for session in list(self.sessions):
+            if session.version in changed:
+                session.notify()
+
+    def poll(self):
+        """
+        Check for a new serial number if we haven't done so recently,
+        and drop any sessions whose clients have stopped reading.
+        """
+
+        if rpki.rtr.channels.Timestamp.now() >= self.last_checked + self.poll_interval:
+            self.notify()
+        for session in list(self.sessions):
+            session.check_stall()
 
 
 class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
@@ -215,6 +685,13 @@ class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
     server's output to a different file descriptor.
     """
 
+    # Bigger than asynchat's default, so that serving a large file
+    # doesn't cost a system call per four kilobytes.
+    ac_out_buffer_size = 65536
+
+    metrics = None
+    channel = None
+
     def __init__(self):
         """
         Set up stdout.
@@ -230,13 +707,32 @@ class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
 
         return False
 
+    def resume_input(self):
+        """
+        Output draining is what lets the ServerChannel we're writing
+        for start reading again, so pass this along to it.
+        """
+
+        if self.channel is not None:
+            self.channel.resume_input()
+
+    def send(self, data):
+        """
+        Count bytes sent.
+        """
+
+        n = super(ServerWriteChannel, self).send(data)
+        if n and self.metrics is not None:
+            self.metrics.count("rpki_rtr_bytes_sent_total", n = n)
+        return n
+
     def push_file(self, f):
         """
-        Write content of a file to stream.
+        Write content of a file (as returned by map_file()) to stream.
         """
 
         try:
-            self.push_with_producer(FileProducer(f, self.ac_out_buffer_size))
+            self.push_with_producer(BufferProducer(f, self.ac_out_buffer_size))
         except OSError, e:
             if e.errno != errno.EAGAIN:
                 raise
@@ -246,9 +742,16 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
     """
     Server protocol engine, handles upcalls from PDUChannel to
     implement protocol logic.
+
+    If stall_timeout is set, we drop the session when the client goes
+    that many seconds without accepting any of the output we have
+    queued for it.  Somebody has to call check_stall() periodically.
     """
 
-    def __init__(self, logger, refresh, retry, expire):
+    # How often (in seconds) to call check_stall().
+    stall_check_interval = 30
+
+    def __init__(self, logger, refresh, retry, expire, stall_timeout = None):
         """
         Set up stdin and stdout as connection and start listening for
         first PDU.
@@ -257,10 +760,14 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
         super(ServerChannel, self).__init__(root_pdu_class = PDU)
         self.init_file_dispatcher(sys.stdin.fileno())
         self.writer = ServerWriteChannel()
+        self.writer.channel = self
         self.logger = logger
         self.refresh = refresh
         self.retry = retry
         self.expire = expire
+        self.stall_timeout = stall_timeout
+        self.metrics = self.writer.metrics = rpki.rtr.metrics.ServerMetrics()
+        self.metrics.count("rpki_rtr_sessions_total")
         self.get_serial()
         self.start_new_pdu()
 
@@ -299,12 +806,91 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
 
         return self.writer.push_file(f)
 
+    def output_queued(self):
+        """
+        Redirect to writer channel.
+        """
+
+        return self.writer.output_queued()
+
+    def output_stalled(self, timeout):
+        """
+        Redirect to writer channel.
+        """
+
+        return self.writer.output_stalled(timeout)
+
+    def discard_output(self, pdu = None):
+        """
+        Redirect to writer channel, and stop processing input, which
+        is our job rather than the writer's.
+        """
+
+        self.input_stopped = True
+        return self.writer.discard_output(pdu)
+
+    def check_stall(self):
+        """
+        Drop this session if the client has stopped reading what we
+        send.  We try once to tell it why, after finishing whatever PDU
+        we were in the middle of, but since it isn't reading, it
+        probably won't hear us.
+        """
+
+        if self.stall_timeout is None or not self.output_stalled(self.stall_timeout):
+            return
+        self.logger.warning("[Client hasn't read anything for %s seconds, %s bytes queued, dropping session]",
+                            self.stall_timeout, self.output_queued())
+        self.metrics.count("rpki_rtr_stalled_sessions_total")
+        if self.version is None:
+            self.discard_output()
+        else:
+            self.discard_output(ErrorReportPDU(version = self.version,
+                                               errno   = ErrorReportPDU.codes["Internal Error"],
+                                               errmsg  = "Client stopped reading, dropping session"))
+        self.exit(1)
+
+    def open_file(self, filename):
+        """
+        Map an AXFR or IXFR file for push_file().  Caller should catch IOError.
+        """
+
+        return map_file(filename)
+
+    def open_ixfr(self, serial):
+        """
+        Get content of the IXFR from serial to our current serial, for
+        push_file().  If the cronjob didn't write one, and didn't skip it
+        as too large, compute it from the AXFR files.  We're the only
+        session in this process, so we can just wait for that.  Caller
+        should catch IOError.
+        """
+
+        try:
+            return self.open_file("%d.ix.%d.v%d" % (self.current_serial, serial, self.version))
+        except IOError:
+            check_ixfr_skipped(self.current_serial, serial, self.version)
+            self.logger.debug("[No IXFR file from serial %d, computing one]", serial)
+            self.metrics.count("rpki_rtr_ixfr_computed_total")
+            return compute_ixfr(self.current_serial, serial, self.version)
+
+    def exit(self, status = 0):
+        """
+        End this session.  We're the only session in this process, so
+        that means exiting.
+        """
+
+        sys.exit(status)
+
     def deliver_pdu(self, pdu):
         """
-        Handle received PDU.
+        Handle received PDU, timing how long it takes to serve queries.
         """
 
+        t = time.time()
         pdu.serve(self)
+        if isinstance(pdu, (SerialQueryPDU, ResetQueryPDU)):
+            self.metrics.observe("rpki_rtr_serve_seconds", time.time() - t)
 
     def get_serial(self):
         """
@@ -333,10 +919,24 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
         We have to check rather than just blindly notifying when kicked
         because the cronjob instance has no good way of knowing which
         protocol version we're running, thus has no good way of knowing
-        whether we care about a particular change set or not.
+        whether we care about a particular change set or not.  If the
+        kick message tells us the version, serial and nonce, we use
+        those rather than reading current.v*.
         """
 
-        if force or self.check_serial():
+        kick = parse_kick(data)
+        if kick is not None and kick[0] != self.version:
+            self.logger.debug("Cronjob kicked me about protocol version %d, ignoring", kick[0])
+            return
+        if kick is not None:
+            old = self.current_serial, self.current_nonce
+            self.current_serial, self.current_nonce = kick[1:]
+            changed = old != kick[1:]
+        else:
+            changed = self.check_serial()
+
+        if force or changed:
+            self.metrics.count("rpki_rtr_notifies_total")
             self.push_pdu(SerialNotifyPDU(version = self.version,
                                           serial  = self.current_serial,
                                           nonce   = self.current_nonce))
@@ -344,15 +944,228 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
             self.logger.debug("Cronjob kicked me but I see no serial change, ignoring")
 
 
+class SessionChannel(ServerChannel):
+    """
+    Server protocol engine for one session in an event-driven server
+    handling many sessions in one process.  Protocol logic is the same
+    as ServerChannel, but we talk to our own socket rather than stdin
+    and stdout, get serial numbers and data from a ServerDatabase shared
+    with the other sessions, and close rather than exiting when done.
+    """
+
+    ac_out_buffer_size = ServerWriteChannel.ac_out_buffer_size
+
+    def __init__(self, sock, database, logger, refresh, retry, expire, stall_timeout = None):
+        # Skip ServerChannel.__init__(), which is all about stdin and stdout.
+        super(ServerChannel, self).__init__(root_pdu_class = PDU, sock = sock)
+        self.database = database
+        self.logger = logger
+        self.refresh = refresh
+        self.retry = retry
+        self.expire = expire
+        self.stall_timeout = stall_timeout
+        self.metrics = database.metrics
+        self.metrics.count("rpki_rtr_sessions_total")
+        database.sessions.add(self)
+        self.get_serial()
+        self.start_new_pdu()
+
+    def writable(self):
+        return asynchat.async_chat.writable(self)
+
+    def push(self, data):
+        return rpki.rtr.channels.PDUChannel.push(self, data)
+
+    def push_with_producer(self, producer):
+        return rpki.rtr.channels.PDUChannel.push_with_producer(self, producer)
+
+    def push_pdu(self, pdu):
+        return rpki.rtr.channels.PDUChannel.push_pdu(self, pdu)
+
+    def send(self, data):
+        n = rpki.rtr.channels.PDUChannel.send(self, data)
+        if n:
+            self.metrics.count("rpki_rtr_bytes_sent_total", n = n)
+        return n
+
+    def output_queued(self):
+        return rpki.rtr.channels.PDUChannel.output_queued(self)
+
+    def output_stalled(self, timeout):
+        return rpki.rtr.channels.PDUChannel.output_stalled(self, timeout)
+
+    def discard_output(self, pdu = None):
+        return rpki.rtr.channels.PDUChannel.discard_output(self, pdu)
+
+    def push_file(self, data):
+        """
+        Write content of a file (as returned by open_file()) to stream.
+        """
+
+        self.push_with_producer(BufferProducer(data, self.ac_out_buffer_size))
+
+    def open_file(self, filename):
+        """
+        Get content of an AXFR or IXFR file from the shared database.
+        Caller should catch IOError.
+        """
+
+        return self.database.read_file(filename)
+
+    def open_ixfr(self, serial):
+        """
+        Get content of an IXFR from the shared database, which computes
+        it if necessary (see read_ixfr()).  Caller should catch IOError
+        and IXFRPending.
+        """
+
+        return self.database.read_ixfr(self.current_serial, serial, self.version)
+
+    def wait_ixfr(self, query):
+        """
+        The IXFR we need to answer query is still being computed.  Stop
+        handling input until it's ready, so that we answer queries in
+        order, and arrange for ixfr_ready() to be called.
+        """
+
+        self.hold_input()
+        self.database.ixfrs.wait(self.current_serial, query.serial, self.version,
+                                 lambda data: self.ixfr_ready(query, data))
+
+    def ixfr_ready(self, query, data):
+        """
+        The IXFR query was waiting for is ready, or data is None if we
+        couldn't compute it.  Answer query, then carry on reading, unless
+        the serial number changed while we were waiting and we have to
+        wait for another IXFR.
+        """
+
+        if self not in self.database.sessions:
+            return
+        if data is None:
+            query.send_cache_reset(self)
+        elif not query.serve_ixfr(self):
+            return
+        self.release_input()
+
+    def get_serial(self):
+        """
+        Get current serial number from the shared database.
+        """
+
+        self.current_serial, self.current_nonce = self.database.get_current(self.version)
+        return self.current_serial
+
+    def exit(self, status = 0):
+        """
+        End this session, leaving the rest of the process alone.
+        """
+
+        self.close()
+
+    def close(self):
+        self.database.sessions.discard(self)
+        asynchat.async_chat.close(self)
+
+    def handle_close(self):
+        """
+        Client closed channel, clean up.
+        """
+
+        self.logger.debug("[Session closed]")
+        self.close()
+
+    def handle_error(self):
+        """
+        Handle errors caught by asyncore main loop: log, then kill this
+        session but not the whole server.
+        """
+
+        self.logger.exception("[Unhandled exception, closing session]")
+        self.close()
+
+
+class ListenerChannel(asyncore.dispatcher, object):
+    """
+    asyncore dispatcher for the listening socket of an event-driven
+    server.  Accepts connections and creates a SessionChannel for each.
+    """
+
+    def __init__(self, sock, database, args):
+        asyncore.dispatcher.__init__(self, sock)            # Old-style class
+        self.accepting = True                               # Caller already called listen()
+        self.database = database
+        self.args = args
+
+    def writable(self):
+        """
+        This socket is never writable.
+        """
+
+        return False
+
+    def handle_accept(self):
+        """
+        Accept a new connection and start a session for it.
+        """
+
+        try:
+            pair = self.accept()
+        except socket.error, e:
+            logging.warning("[accept() failed: %s]", e)
+            return
+        if pair is None:
+            return
+        s, ai = pair
+        host, port = ai[0:2]
+        tag = "/tcp/%s.%s" % (host, port) if ":" in host else "/tcp/%s:%s" % (host, port)
+        logger = logging.LoggerAdapter(logging.root, dict(connection = tag, context = tag))
+        logger.debug("[Received connection]")
+        SessionChannel(sock = s, database = self.database, logger = logger,
+                       refresh = self.args.refresh, retry = self.args.retry, expire = self.args.expire,
+                       stall_timeout = self.args.stall_timeout)
+
+    def log(self, msg):
+        """
+        Intercept asyncore's logging.
+        """
+
+        logging.info(msg)
+
+    def log_info(self, msg, tag = "info"):
+        """
+        Intercept asyncore's logging.
+        """
+
+        logging.info("asyncore: %s: %s", tag, msg)
+
+    def handle_error(self):
+        """
+        Handle errors caught by asyncore main loop.
+        """
+
+        logging.exception("[Unhandled exception in listener]")
+
+
 class KickmeChannel(asyncore.dispatcher, object):
     """
     asyncore dispatcher for the PF_UNIX socket that cronjob mode uses to
     kick servers when it's time to send notify PDUs to clients.
     """
 
-    def __init__(self, server):
+    # Minimum interval (in seconds) between metrics reports to the listener.
+    report_interval = 1
+
+    def __init__(self, server, sock = None):
         asyncore.dispatcher.__init__(self)                  # Old-style class
         self.server = server
+        self.last_report = 0
+        if sock is not None:
+            # Inherited from a listener relaying kicks, no inode of our own.
+            self.sockname = None
+            sock.setblocking(0)
+            self.set_socket(sock)
+            return
         self.sockname = "%s.%d" % (kickme_base, os.getpid())
         self.create_socket(socket.AF_UNIX, socket.SOCK_DGRAM)
         try:
@@ -386,12 +1199,33 @@ class KickmeChannel(asyncore.dispatcher, object):
         data = self.recv(512)
         self.server.notify(data)
 
+    def report_metrics(self, force = False, sessions_active = None):
+        """
+        If we're talking to a listener rather than the cronjob, send it
+        a snapshot of our metrics, at most once per report_interval
+        unless forced.  Event-driven servers also report how many
+        sessions they have open.
+        """
+
+        now = time.time()
+        if self.sockname is not None:
+            return
+        if not force and now < self.last_report + self.report_interval:
+            return
+        self.last_report = now
+        try:
+            self.socket.send(self.server.metrics.snapshot(sessions_active))
+        except socket.error, e:
+            self.server.logger.debug("[Couldn't report metrics to listener: %s]", e)
+
     def cleanup(self):
         """
         Clean up this dispatcher's socket.
         """
 
         self.close()
+        if self.sockname is None:
+            return
         try:
             os.unlink(self.sockname)
         except:
@@ -468,7 +1302,7 @@ def hostport_tag():
         return "/%s/%s:%s" % (proto, host, port)
 
 
-def server_main(args):
+def server_main(args, kick_sock = None):
     """
     Implement the server side of the rpkk-router protocol.  Other than
     one PF_UNIX socket inode, this doesn't write anything to disk, so it
@@ -477,6 +1311,9 @@ def server_main(args):
     pass the results along to a client.
     """
 
+    # kick_sock is a socket over which the listener which forked us
+    # relays kicks, in which case we don't need a kickme socket inode.
+
     logger = logging.LoggerAdapter(logging.root, dict(connection = hostport_tag()))
 
     logger.debug("[Starting]")
@@ -490,30 +1327,29 @@ def server_main(args):
 
     kickme = None
     try:
-        server = rpki.rtr.server.ServerChannel(logger = logger, refresh = args.refresh, retry = args.retry, expire = args.expire)
-        kickme = rpki.rtr.server.KickmeChannel(server = server)
-        asyncore.loop(timeout = None)
+        server = rpki.rtr.server.ServerChannel(logger = logger, refresh = args.refresh, retry = args.retry, expire = args.expire,
+                                               stall_timeout = args.stall_timeout)
+        kickme = rpki.rtr.server.KickmeChannel(server = server, sock = kick_sock)
+        while asyncore.socket_map:
+            asyncore.loop(timeout = server.stall_check_interval, use_poll = True, count = 1)
+            server.check_stall()
+            kickme.report_metrics()
         signal.signal(signal.SIGINT, signal.SIG_IGN) # Theorized race condition
     except KeyboardInterrupt:
         sys.exit(0)
     finally:
         signal.signal(signal.SIGINT, signal.SIG_IGN) # Observed race condition
         if kickme is not None:
+            kickme.report_metrics(force = True)
             kickme.cleanup()
 
 
-def listener_main(args):
+def open_listener(port, backlog = 5):
     """
-    Totally insecure TCP listener for rpki-rtr protocol.  We only
-    implement this because it's all that the routers currently support.
-    In theory, we will all be running TCP-AO in the future, at which
-    point this listener will go away or become a TCP-AO listener.
+    Open a TCP socket listening on the specified port, on IPv6 and IPv4
+    if we can, otherwise just IPv4.
     """
 
-    # Perhaps we should daemonize?  Deal with that later.
-
-    # server_main() handles args.rpki_rtr_dir.
-
     listener = None
     try:
         listener = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
@@ -527,34 +1363,372 @@ def listener_main(args):
         listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     except AttributeError:
         pass
-    listener.bind(("", args.port))
-    listener.listen(5)
+    listener.bind(("", port))
+    listener.listen(backlog)
+    return listener
+
+
+def event_listener_main(args, kick_sock = None, listen_sock = None):
+    """
+    Event-driven TCP listener: serve all sessions from this one process,
+    sharing one ServerDatabase and one kickme socket, instead of forking
+    a server process for every connection.
+    """
+
+    # kick_sock is a socket over which a prefork supervisor relays kicks
+    # and collects our metrics.  listen_sock is a listening socket it
+    # opened for us, if we can't open our own with SO_REUSEPORT.
+
+    if args.rpki_rtr_dir:
+        try:
+            os.chdir(args.rpki_rtr_dir)
+        except OSError, e:
+            logging.error("[Couldn't chdir(%r), exiting: %s]", args.rpki_rtr_dir, e)
+            sys.exit(1)
+
+    database = ServerDatabase(logger = logging.root)
+    if listen_sock is None:
+        listen_sock = open_listener(args.port, socket.SOMAXCONN)
+    listener = ListenerChannel(sock = listen_sock, database = database, args = args)
     logging.debug("[Listening on port %s]", args.port)
-    while True:
+
+    if kick_sock is not None:
+        database.preload()
+
+    timeout = SessionChannel.stall_check_interval
+    if args.metrics_file:
+        timeout = min(timeout, args.metrics_interval)
+    if kick_sock is not None:
+        timeout = min(timeout, KickmeChannel.report_interval)
+    next_metrics = time.time()
+
+    kickme = None
+    try:
+        kickme = KickmeChannel(server = database, sock = kick_sock)
+        while True:
+            asyncore.loop(timeout = timeout, use_poll = True, count = 1)
+            database.poll()
+            if kick_sock is not None:
+                kickme.report_metrics(sessions_active = len(database.sessions))
+            elif args.metrics_file and time.time() >= next_metrics:
+                database.metrics.write(args.metrics_file, sessions_active = len(database.sessions))
+                next_metrics = time.time() + args.metrics_interval
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if kickme is not None:
+            if kick_sock is not None:
+                kickme.report_metrics(force = True, sessions_active = len(database.sessions))
+            kickme.cleanup()
+        listener.close()
+
+
+def open_broker(args):
+    """
+    Bind the kickme socket on behalf of the servers we fork, so they
+    don't need kickme socket inodes of their own; we relay kicks to
+    them over socketpairs.  Returns the socket, or None if we couldn't
+    bind it, and the socket's name.
+    """
+
+    broker = None
+    brokername = os.path.join(args.rpki_rtr_dir or ".", "%s.%d" % (kickme_base, os.getpid()))
+    try:
+        broker = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        broker.bind(brokername)
+        os.chmod(brokername, 0660)
+    except (socket.error, OSError), e:
+        logging.warning("[Couldn't set up kickme socket %s, servers will use their own: %s]", brokername, e)
+        if broker is not None:
+            broker.close()
+        broker = None
+    return broker, brokername
+
+
+def close_broker(broker, brokername):
+    """
+    Close and unlink a socket returned by open_broker().
+    """
+
+    if broker is not None:
+        broker.close()
         try:
-            s, ai = listener.accept()
-        except KeyboardInterrupt:
-            sys.exit(0)
-        logging.debug("[Received connection from %r]", ai)
-        pid = os.fork()
-        if pid == 0:
-            os.dup2(s.fileno(), 0)      # pylint: disable=E1101
-            os.dup2(s.fileno(), 1)      # pylint: disable=E1101
-            s.close()
-            #os.closerange(3, os.sysconf("SC_OPEN_MAX"))
-            server_main(args)
-            sys.exit()
+            os.unlink(brokername)
+        except OSError:
+            pass
+
+
+def relay_kick(broker, children):
+    """
+    Relay a kick from the cronjob to all of our children.
+    """
+
+    data = broker.recv(512)
+    for pid, sock in children.items():
+        try:
+            sock.send(data)
+        except socket.error, e:
+            logging.debug("[Couldn't relay kick to server %d: %s]", pid, e)
+
+
+def recv_metrics(sock):
+    """
+    Read all the metrics snapshots waiting on a relay socket, and
+    return the most recent one, or None if there weren't any.  We can't
+    rely on select() to tell us when a child has exited (datagram
+    sockets don't see EOF), so this is also how we drain a dead child's
+    socket.
+    """
+
+    metrics = None
+    sock.setblocking(0)
+    try:
+        while True:
+            metrics = rpki.rtr.metrics.ServerMetrics.from_snapshot(sock.recv(65536))
+    except socket.error, e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            logging.debug("[Couldn't read metrics from relay socket: %s]", e)
+    return metrics
+
+
+def run_child(func, *args):
+    """
+    Run func in a process we've just forked, and exit when it does,
+    rather than unwinding into our parent's cleanup code.
+    """
+
+    status = 1
+    try:
+        func(*args)
+        status = 0
+    except SystemExit, e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
         else:
-            logging.debug("[Spawned server %d]", pid)
+            sys.stderr.write("%s\n" % e.code)
+    except:
+        logging.exception("[Unhandled exception in child %d]", os.getpid())
+    finally:
+        os._exit(status)
+
+
+def listener_main(args):
+    """
+    Totally insecure TCP listener for rpki-rtr protocol.  We only
+    implement this because it's all that the routers currently support.
+    In theory, we will all be running TCP-AO in the future, at which
+    point this listener will go away or become a TCP-AO listener.
+    """
+
+    # Perhaps we should daemonize?  Deal with that later.
+
+    if args.workers:
+        return prefork_listener_main(args)
+
+    if args.single_process:
+        return event_listener_main(args)
+
+    # server_main() handles args.rpki_rtr_dir.
+
+    listener = open_listener(args.port)
+    logging.debug("[Listening on port %s]", args.port)
+
+    # Rather than every server we fork binding its own kickme socket,
+    # we bind one and relay kicks to our children over socketpairs.
+
+    broker, brokername = open_broker(args)
+    children = {}
+
+    # Servers send snapshots of their metrics back up their relay
+    # sockets.
+
+    metrics = rpki.rtr.metrics.ChildMetrics()
+    next_metrics = time.time()
+    timeout = args.metrics_interval * 1000 if args.metrics_file else None
+
+    # We use poll() rather than select() because with a relay socket
+    # per child we can easily have more descriptors than select() can
+    # handle.  relays maps relay socket descriptors back to child pids.
+
+    poller = select.poll()
+    poller.register(listener, select.POLLIN)
+    if broker is not None:
+        poller.register(broker, select.POLLIN)
+    relays = {}
+
+    try:
+        while True:
+            try:
+                readable = set(fd for fd, event in poller.poll(timeout))
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if broker is not None and broker.fileno() in readable:
+                relay_kick(broker, children)
+            for fd in readable:
+                if fd in relays:
+                    pid = relays[fd]
+                    metrics.update(pid, recv_metrics(children[pid]))
+            if listener.fileno() in readable:
+                s, ai = listener.accept()
+                logging.debug("[Received connection from %r]", ai)
+                kick_sock = None
+                if broker is not None:
+                    relay_sock, kick_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                pid = os.fork()
+                if pid == 0:
+                    os.dup2(s.fileno(), 0)      # pylint: disable=E1101
+                    os.dup2(s.fileno(), 1)      # pylint: disable=E1101
+                    s.close()
+                    listener.close()
+                    if broker is not None:
+                        broker.close()
+                        relay_sock.close()
+                    for sock in children.itervalues():
+                        sock.close()
+                    #os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+                    run_child(server_main, args, kick_sock)
+                else:
+                    s.close()
+                    if kick_sock is not None:
+                        kick_sock.close()
+                        children[pid] = relay_sock
+                        relays[relay_sock.fileno()] = pid
+                        poller.register(relay_sock, select.POLLIN)
+                    logging.debug("[Spawned server %d]", pid)
             while True:
                 try:
                     pid, status = os.waitpid(0, os.WNOHANG)
                     if pid:
                         logging.debug("[Server %s exited with status 0x%x]", pid, status)
+                        if pid in children:
+                            sock = children.pop(pid)
+                            metrics.update(pid, recv_metrics(sock))
+                            poller.unregister(sock)
+                            del relays[sock.fileno()]
+                            sock.close()
+                            metrics.retire(pid)
                         continue
                 except:
                     pass
                 break
+            if args.metrics_file and time.time() >= next_metrics:
+                metrics.total().write(args.metrics_file, sessions_active = len(children) if broker is not None else None)
+                next_metrics = time.time() + args.metrics_interval
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        close_broker(broker, brokername)
+
+
+def prefork_listener_main(args):
+    """
+    Prefork TCP listener: run a fixed pool of event-driven worker
+    processes, each serving many sessions from its own SO_REUSEPORT
+    listening socket, so that the kernel spreads new connections across
+    the workers.  We relay kicks from the cronjob to the workers,
+    collect their metrics, and restart any worker which dies.
+    """
+
+    # How long (in seconds) a worker must have been running for us to
+    # restart it immediately when it dies.  Workers which die faster
+    # than this are probably failing at startup, so we wait this long
+    # before trying again rather than spinning.
+
+    restart_delay = 5
+
+    # Without SO_REUSEPORT we can't have a listening socket per worker,
+    # so we open one here and the workers share it.
+
+    listen_sock = None
+    if not hasattr(socket, "SO_REUSEPORT"):
+        logging.warning("[SO_REUSEPORT not supported, workers will share one listening socket]")
+        listen_sock = open_listener(args.port, socket.SOMAXCONN)
+
+    broker, brokername = open_broker(args)
+    workers = {}
+    started = {}
+    restarts = []
+    metrics = rpki.rtr.metrics.ChildMetrics()
+    next_metrics = time.time()
+
+    def start_worker():
+        relay_sock, kick_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            relay_sock.close()
+            if broker is not None:
+                broker.close()
+            for sock in workers.itervalues():
+                sock.close()
+            run_child(event_listener_main, args, kick_sock, listen_sock)
+        kick_sock.close()
+        workers[pid] = relay_sock
+        started[pid] = time.time()
+        logging.info("[Started worker %d]", pid)
+
+    # Treat SIGTERM like SIGINT, so that we clean up our workers.
+
+    def sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, sigterm)
+
+    try:
+        for i in xrange(args.workers):
+            start_worker()
+        while True:
+            try:
+                readable = select.select(([] if broker is None else [broker]) + workers.values(), [], [], 1)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if broker is not None and broker in readable:
+                relay_kick(broker, workers)
+            for pid, sock in workers.items():
+                if sock in readable:
+                    metrics.update(pid, recv_metrics(sock))
+            now = time.time()
+            while True:
+                try:
+                    pid, status = os.waitpid(0, os.WNOHANG)
+                except OSError:
+                    break
+                if not pid:
+                    break
+                if pid not in workers:
+                    continue
+                logging.warning("[Worker %d exited with status 0x%x, restarting]", pid, status)
+                sock = workers.pop(pid)
+                metrics.update(pid, recv_metrics(sock))
+                sock.close()
+                metrics.retire(pid)
+                if now - started.pop(pid) < restart_delay:
+                    restarts.append(now + restart_delay)
+                else:
+                    restarts.append(now)
+                restarts.sort()
+            while restarts and restarts[0] <= now:
+                del restarts[0]
+                start_worker()
+            if args.metrics_file and now >= next_metrics:
+                metrics.total().write(args.metrics_file)
+                next_metrics = now + args.metrics_interval
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        close_broker(broker, brokername)
 
 
 def argparse_setup(subparsers):
@@ -574,6 +1748,18 @@ def argparse_setup(subparsers):
     def expire(v):
         return rpki.rtr.pdus.valid_expire(int(v))
 
+    def stall_timeout(v):
+        v = int(v)
+        if v <= 0:
+            raise ValueError
+        return v
+
+    def workers(v):
+        v = int(v)
+        if v < 0:
+            raise ValueError
+        return v
+
     # Some duplication of arguments here, not enough to be worth huge
     # effort to clean up, worry about it later in any case.
 
@@ -583,6 +1769,8 @@ def argparse_setup(subparsers):
     subparser.add_argument("--refresh", type = refresh, help = "override default refresh timer")
     subparser.add_argument("--retry",   type = retry,   help = "override default retry timer")
     subparser.add_argument("--expire",  type = expire,  help = "override default expire timer")
+    subparser.add_argument("--stall-timeout", type = stall_timeout, default = 300,
+                           help = "seconds a client may go without reading queued output before we drop it")
     subparser.add_argument("rpki_rtr_dir", nargs = "?", help = "directory containing RPKI-RTR database")
 
     subparser = subparsers.add_parser("listener", description = listener_main.__doc__,
@@ -591,5 +1779,16 @@ def argparse_setup(subparsers):
     subparser.add_argument("--refresh", type = refresh, help = "override default refresh timer")
     subparser.add_argument("--retry",   type = retry,   help = "override default retry timer")
     subparser.add_argument("--expire",  type = expire,  help = "override default expire timer")
+    subparser.add_argument("--stall-timeout", type = stall_timeout, default = 300,
+                           help = "seconds a client may go without reading queued output before we drop it")
+    subparser.add_argument("--metrics-file",
+                           help = "file to which to write metrics in Prometheus text format")
+    subparser.add_argument("--metrics-interval", type = int, default = 15,
+                           help = "seconds between updates of --metrics-file")
+    group = subparser.add_mutually_exclusive_group()
+    group.add_argument("--single-process", action = "store_true",
+                       help = "serve all sessions from one event-driven process instead of forking per connection")
+    group.add_argument("--workers", type = workers, default = 0,
+                       help = "serve sessions from this many event-driven worker processes, each with its own SO_REUSEPORT socket")
     subparser.add_argument("port",      type = int,     help = "TCP port on which to listen")
     subparser.add_argument("rpki_rtr_dir", nargs = "?", help = "directory containing RPKI-RTR database")